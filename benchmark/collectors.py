@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# End-to-end load benchmark of the collector scripts against local fakes (see fakes.py)
+# Every collection cycle runs as its own process, as from cron: a cold cycle (no
+# discovery cache) then warm ones. Reports wall time, items, round-trips and bytes
+# exchanged with the monitored service and the Zabbix trapper, and peak RSS, as
+# the number of users and connectors (Jasmin) or queues (RabbitMQ) grows.
+
+import os, sys, imp, json, time, shutil, argparse, resource, tempfile, subprocess
+
+parser = argparse.ArgumentParser(description='Collectors end-to-end load benchmark')
+parser.add_argument('--jasmin', type=int, nargs='*', default=[100, 1000, 10000],
+    help = "Numbers of Jasmin users (with one connector per 10 users)")
+parser.add_argument('--rabbitmq', type=int, nargs='*', default=[100, 1000, 10000], help = "Numbers of RabbitMQ queues")
+parser.add_argument('--cycles', type=int, default=2, help = "Collection cycles per N, the first one is cold")
+parser.add_argument('--args', default='', help = "Extra arguments given to collector scripts, e.g. '--sessions 4'")
+parser.add_argument('--run', nargs=4, metavar=('NAME', 'STATE', 'SERVICE_PORT', 'ZABBIX_PORT'), help = argparse.SUPPRESS)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+# Collector scripts import script/common/ modules, installed next to their own script/
+sys.path.insert(0, os.path.join(here, '..', 'common', 'script', 'common'))
+
+def load_script(name, argv):
+    "Load <name>/<name>_get.py as a module, its module level arguments parsing being given argv"
+    path = os.path.join(here, '..', name, 'script', name, '%s_get.py' % name)
+    saved = sys.argv
+    sys.argv = [path] + argv
+    try:
+        return imp.load_source('%s_get' % name, path)
+    finally:
+        sys.argv = saved
+
+def run(name, state, service_port, zabbix_port):
+    """Run one collection cycle of 'name' against the fakes, keeping files in the
+    'state' directory, print its wall time, items and peak RSS (KB)"""
+    # Collected services are reached at --hostname
+    m = load_script(name, ['--hostname', '127.0.0.1', '--spool-size', '0'] + args.args.split())
+    m.zabbix_host = '127.0.0.1'
+    m.zabbix_port = zabbix_port
+    sender = m.ZabbixBatchSender(m.zabbix_host, m.zabbix_port, batch_size = m.args.zabbix_batch_size,
+        concurrency = m.args.zabbix_senders)
+
+    t = time.time()
+    if name == 'jasmin':
+        m.jcli['nodes'] = {'benchmark': ('127.0.0.1', service_port)}
+        m.discovery_cache = os.path.join(state, 'jasmin_discovery_%s.json')
+        m.args.tiers_state = os.path.join(state, 'jasmin_get.tiers')
+        nodes = m.build_nodes(m.args.interval / 2)
+        metrics = m.collect_cycle(nodes)
+        for node in nodes:
+            node.close()
+    else:
+        m.rabbitmq['port'] = service_port
+        client = m.ManagementClient(m.rabbitmq['host'], service_port, m.rabbitmq['username'], m.rabbitmq['password'])
+        selector = m.QueueSelector(os.path.join(state, 'rabbitmq_queues.json'), m.args.top, m.args.top_by,
+            m.thresholds, m.args.hold)
+        metrics = m.collect(client, selector)
+        client.close()
+    sender.send(metrics)
+    sender.close()
+
+    print time.time() - t, len(metrics), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def main():
+    if args.run is not None:
+        run(args.run[0], args.run[1], int(args.run[2]), int(args.run[3]))
+        return
+
+    import fakes
+    # jasmin_get parses its own command line when imported
+    jasmin_get = load_script('jasmin', ['--hostname', 'benchmark'])
+    api_keys = sorted(set(k for key in jasmin_get.keys if type(key) == dict
+        for table in ['smppsapi', 'httpapi'] if table in key for k in key[table]))
+
+    trapper = fakes.FakeTrapper().start()
+    runs = [('jasmin', n, lambda n: fakes.FakeJcli(n, max(1, n / 10), api_keys)) for n in args.jasmin]
+    runs += [('rabbitmq', n, lambda n: fakes.FakeManagement(n)) for n in args.rabbitmq]
+
+    try:
+        print '%-9s %7s %6s %9s %8s %9s %10s %8s %10s %9s' % ('collector', 'N', 'cycle', 'wall (s)', 'items',
+            'src reqs', 'src KB', 'zbx reqs', 'zbx KB', 'RSS (MB)')
+        for name, n, fake in runs:
+            service = fake(n).start()
+            state = tempfile.mkdtemp(prefix = 'benchmark_')
+            try:
+                for cycle in range(args.cycles):
+                    service.counters.reset()
+                    trapper.counters.reset()
+                    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--args=%s' % args.args,
+                        '--run', name, state, str(service.port), str(trapper.port)])
+                    wall, items, rss = out.split()[-3:]
+                    s, z = service.counters, trapper.counters
+                    print '%-9s %7d %6s %9.3f %8s %9d %10.1f %8d %10.1f %9.1f' % (name, n,
+                        'cold' if cycle == 0 else 'warm', float(wall), items,
+                        s.requests, (s.bytes_in + s.bytes_out) / 1024.0, z.requests, (z.bytes_in + z.bytes_out) / 1024.0,
+                        int(rss) / 1024.0)
+                    sys.stdout.flush()
+            finally:
+                service.shutdown()
+                service.server_close()
+                shutil.rmtree(state)
+    finally:
+        trapper.shutdown()
+        trapper.server_close()
+
+if __name__ == '__main__':
+    main()
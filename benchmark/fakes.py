@@ -0,0 +1,218 @@
+# Local stand-ins for the servers collector scripts talk to: Zabbix trapper, jCli
+# and RabbitMQ management API. Each one serves synthetic data for N users,
+# connectors or queues from a daemon thread and counts connections, requests
+# (round-trips) and bytes it exchanged.
+
+import os, json, math, socket, struct, threading, urlparse, SocketServer, BaseHTTPServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+class Counters(object):
+    "Connections, requests and bytes seen by a fake server"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+class CountingFile(object):
+    "Wrap a request handler's rfile or wfile, counting bytes read or written"
+
+    def __init__(self, f, counters, name):
+        self.f = f
+        self.counters = counters
+        self.name = name
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.counters.add(**{self.name: len(data)})
+        return data
+
+    def readline(self, *args):
+        data = self.f.readline(*args)
+        self.counters.add(**{self.name: len(data)})
+        return data
+
+    def write(self, data):
+        self.counters.add(**{self.name: len(data)})
+        self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class CountingHandler(SocketServer.StreamRequestHandler):
+    "Request handler counting its connection and bytes into server.counters"
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # Responses are written as they are ready, do not let Nagle's algorithm hold them
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.counters.add(connections = 1)
+        self.rfile = CountingFile(self.rfile, self.server.counters, 'bytes_in')
+        self.wfile = CountingFile(self.wfile, self.server.counters, 'bytes_out')
+
+class FakeServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    "Base of fake servers, listening on 127.0.0.1:port (0 for any free port)"
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, handler, port = 0):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), handler)
+        self.port = self.server_address[1]
+        self.counters = Counters()
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+class TrapperHandler(CountingHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(13)
+            if len(header) < 13 or header[:5] != 'ZBXD\x01':
+                return
+            data = json.loads(self.rfile.read(struct.unpack('<Q', header[5:])[0]))
+            self.server.counters.add(requests = 1)
+            self.server.items += len(data['data'])
+
+            response = json.dumps({'response': 'success',
+                'info': 'processed: %d; failed: 0; total: %d; seconds spent: 0.000100' % (len(data['data']), len(data['data']))})
+            self.wfile.write('ZBXD\x01' + struct.pack('<Q', len(response)) + response)
+            self.wfile.flush()
+
+class FakeTrapper(FakeServer):
+    "Zabbix trapper accepting every item of every 'sender data' request"
+
+    def __init__(self, port = 0):
+        FakeServer.__init__(self, TrapperHandler, port)
+        self.items = 0
+
+def fixture(name):
+    "Fixture's jCli response, without its command line"
+    with open(os.path.join(here, 'fixtures', name)) as f:
+        return f.read().split('\n', 1)[1].replace('jcli : ', '')
+
+class JcliHandler(CountingHandler):
+    def handle(self):
+        self.wfile.write('Authentication required.\r\n\r\n')
+        self.rfile.readline()
+        self.wfile.write('Username: ')
+        self.rfile.readline()
+        self.wfile.write('Password: ')
+        self.rfile.readline()
+        self.wfile.write('Welcome to Jasmin 0.9.31 console\r\nType help or ? to list commands.\r\n\r\njcli : ')
+        self.wfile.flush()
+
+        while True:
+            line = self.rfile.readline()
+            if not line or line.strip() == 'quit':
+                return
+            self.server.counters.add(requests = 1)
+            self.wfile.write(self.server.response(line.split()) + 'jcli : ')
+            self.wfile.flush()
+
+class FakeJcli(FakeServer):
+    """jCli with 'users' users (user0, user1 ...) and 'smppcs' connectors
+    (smppc0, smppc1 ...), their stats are those of fixtures/
+
+    'api_keys' are the keys of 'stats --smppsapi' and 'stats --httpapi' tables.
+    """
+
+    def __init__(self, users, smppcs, api_keys, port = 0):
+        FakeServer.__init__(self, JcliHandler, port)
+        self.users = users
+        self.smppcs = smppcs
+        self.user = fixture('stats_user.txt')
+        self.smppc = fixture('stats_smppc.txt')
+        self.api = '#Item                     Value\n' + ''.join('#%-24s %d\n' % (k, i) for i, k in enumerate(api_keys))
+
+    def response(self, command):
+        if command[:2] == ['stats', '--users']:
+            return '#User id  Type  Value\n' + ''.join('#user%d  SMPP Server  0\n' % i for i in range(self.users))
+        elif command[:2] == ['stats', '--smppcs']:
+            return '#Connector id  Connected at\n' + ''.join('#smppc%d  ND\n' % i for i in range(self.smppcs))
+        elif command[:2] == ['smppccm', '-l']:
+            return ('#Connector id  Service  Session  Starts  Stops\n' +
+                ''.join('#smppc%d  started  BOUND_TRX  1  0\n' % i for i in range(self.smppcs)) +
+                'Total connectors: %d\n' % self.smppcs)
+        elif command[:2] == ['stats', '--user']:
+            return self.user
+        elif command[:2] == ['stats', '--smppc']:
+            return self.smppc
+        elif command[:2] in (['stats', '--smppsapi'], ['stats', '--httpapi']):
+            return self.api
+        return 'Unknown command: %s\n' % ' '.join(command)
+
+class ManagementHandler(BaseHTTPServer.BaseHTTPRequestHandler, CountingHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Handlers are old-style classes, lookup is depth-first
+        CountingHandler.setup(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, obj):
+        body = json.dumps(obj)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.counters.add(requests = 1)
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        if url.path.startswith('/api/aliveness-test/'):
+            self.reply({'status': 'ok'})
+        elif url.path.startswith('/api/vhosts/'):
+            self.reply(self.server.vhost)
+        elif url.path.startswith('/api/queues/'):
+            self.reply(self.server.page(params))
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+class FakeManagement(FakeServer):
+    """RabbitMQ management API with one vhost holding 'queues' queues (queue0,
+    queue1 ...), queues listing honours 'columns' and pagination"""
+
+    def __init__(self, queues, port = 0):
+        FakeServer.__init__(self, ManagementHandler, port)
+        self.queues = queues
+        self.vhost = {'name': '/', 'messages': 0, 'messages_ready': 0, 'messages_unacknowledged': 0,
+            'recv_oct': 1000, 'send_oct': 2000,
+            'message_stats': {'ack': 10, 'deliver': 11, 'deliver_get': 11, 'get_no_ack': 0, 'publish': 12}}
+
+    def queue(self, i):
+        return {'name': 'queue%d' % i, 'vhost': '/', 'messages': i % 100, 'messages_ready': i % 100,
+            'messages_unacknowledged': 0, 'memory': 10000 + i, 'consumers': 1, 'state': 'running',
+            'durable': True, 'auto_delete': False, 'arguments': {}, 'node': 'rabbit@benchmark'}
+
+    def page(self, params):
+        columns = params['columns'].split(',') if 'columns' in params else None
+        page = int(params.get('page', 1))
+        page_size = max(1, int(params.get('page_size', self.queues)))
+        items = []
+        for i in xrange((page - 1) * page_size, min(page * page_size, self.queues)):
+            queue = self.queue(i)
+            items.append(queue if columns is None else dict((k, queue[k]) for k in columns if k in queue))
+        return {'items': items, 'page': page, 'page_size': page_size, 'item_count': len(items),
+            'page_count': int(math.ceil(self.queues / float(page_size))), 'filtered_count': self.queues,
+            'total_count': self.queues}
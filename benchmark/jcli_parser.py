@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Micro-benchmark of jCli stats parsing in jasmin_get.py
+# Compares the former regex-per-key parsing with the single-pass parse_stats()
+# on captured 'stats --user' and 'stats --smppc' outputs (see fixtures/)
+
+import os, re, sys, time, argparse
+
+parser = argparse.ArgumentParser(description='jCli stats parser micro-benchmark')
+parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000], help = "Number of users to parse")
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'jasmin', 'script', 'jasmin'))
+sys.path.insert(0, os.path.join(here, '..', 'common', 'script', 'common'))
+# jasmin_get parses its own command line when imported
+sys.argv = [sys.argv[0], '--hostname', 'benchmark']
+import jasmin_get
+
+user_keys = [k for k in jasmin_get.keys if type(k) == dict and 'users' in k][0]['users']
+smppc_keys = [k for k in jasmin_get.keys if type(k) == dict and 'smppcs' in k][0]['smppcs']
+
+def legacy_get_stats_value(response, key, stat_type = None):
+    "get_stats_value() as it was before parse_stats()"
+    if stat_type is None:
+        p = r"#%s\s+([0-9A-Za-z -:'\{\}_]+)" % key
+    else:
+        p = r"#%s\s+%s\s+([0-9A-Za-z -:'\{\}_]+)" % (key, stat_type)
+
+    m = re.search(p, response, re.MULTILINE)
+    if not m:
+        raise jasmin_get.jCliKeyError('Key (%s) not found !' % key)
+    else:
+        return m.group(1)
+
+def legacy_user(response):
+    values = {}
+    for k in user_keys['httpapi']:
+        values[('HTTP Api', k)] = legacy_get_stats_value(response, k, stat_type = 'HTTP Api')
+    for k in user_keys['smppsapi']:
+        if k in ['bound_rx_count', 'bound_tx_count', 'bound_trx_count']:
+            values[('SMPP Server', k)] = legacy_get_stats_value(response, 'bound_connections_count', stat_type = 'SMPP Server')
+        else:
+            values[('SMPP Server', k)] = legacy_get_stats_value(response, k, stat_type = 'SMPP Server')
+    return values
+
+def new_user(response):
+    values = {}
+    stats = jasmin_get.parse_stats(response)
+    for k in user_keys['httpapi']:
+        values[('HTTP Api', k)] = jasmin_get.get_stats_value(stats, k, stat_type = 'HTTP Api')
+    for k in user_keys['smppsapi']:
+        if k in ['bound_rx_count', 'bound_tx_count', 'bound_trx_count']:
+            values[('SMPP Server', k)] = jasmin_get.get_stats_value(stats, 'bound_connections_count', stat_type = 'SMPP Server')
+        else:
+            values[('SMPP Server', k)] = jasmin_get.get_stats_value(stats, k, stat_type = 'SMPP Server')
+    return values
+
+def legacy_smppc(response):
+    return dict((k, legacy_get_stats_value(response, k)) for k in smppc_keys)
+
+def new_smppc(response):
+    stats = jasmin_get.parse_stats(response)
+    return dict((k, jasmin_get.get_stats_value(stats, k)) for k in smppc_keys)
+
+def bench(fn, response, count):
+    t = time.time()
+    for i in xrange(count):
+        fn(response)
+    return time.time() - t
+
+def main():
+    user = open(os.path.join(here, 'fixtures', 'stats_user.txt')).read()
+    smppc = open(os.path.join(here, 'fixtures', 'stats_smppc.txt')).read()
+
+    # Both parsers must agree before being compared
+    assert legacy_user(user) == new_user(user)
+    assert legacy_smppc(smppc) == new_smppc(smppc)
+
+    print '%-8s %8s %12s %12s %12s %8s' % ('table', 'count', 'legacy (s)', 'new (s)', 'new (us/1)', 'speedup')
+    for name, legacy, new, response in [('user', legacy_user, new_user, user),
+        ('smppc', legacy_smppc, new_smppc, smppc)]:
+        for count in args.users:
+            l = bench(legacy, response, count)
+            n = bench(new, response, count)
+            print '%-8s %8d %12.3f %12.3f %12.1f %7.1fx' % (name, count, l, n, n / count * 1e6, l / n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# Benchmark of jCli responses reading in jasmin_jcli.py, against fakes.FakeJcli
+# Compares the former Telnet.expect() reading with jCliSession.read_lines() on
+# pipelined 'stats --user' commands and on 'stats --users' listings of N users
+
+import os, sys, time, argparse
+from telnetlib import Telnet
+
+parser = argparse.ArgumentParser(description='jCli reader benchmark')
+parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 30000], help = "Number of users")
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'jasmin', 'script', 'jasmin'))
+sys.path.insert(0, os.path.join(here, '..', 'common', 'script', 'common'))
+# jasmin_get parses its own command line when imported
+sys.argv = [sys.argv[0], '--hostname', '127.0.0.1']
+import jasmin_get, jasmin_jcli, fakes
+
+def legacy_session():
+    "A plain Telnet session, as jcli_connect() opened them before jCliSession"
+    tn = Telnet(jasmin_get.jcli['host'], jasmin_get.jcli['port'])
+    tn.set_option_negotiation_callback(jasmin_jcli.process_option)
+    tn.read_until('Authentication required', 16)
+    tn.write("\r\n")
+    tn.read_until("Username:", 16)
+    tn.write(jasmin_get.jcli['username'] + "\r\n")
+    tn.read_until("Password:", 16)
+    tn.write(jasmin_get.jcli['password'] + "\r\n")
+    tn.expect([r'Welcome to Jasmin ([0-9a-z\.]+) console'], 16)
+    tn.expect([r'jcli :'], 16)
+    return tn
+
+def legacy_stats(tn, commands, batch_size = 50):
+    "wait_for_prompts() as it was before jCliSession"
+    responses = []
+    for i in range(0, len(commands), batch_size):
+        batch = commands[i:i + batch_size]
+        tn.write(''.join(batch))
+        for command in batch:
+            idx, obj, response = tn.expect([r'jcli :'], 600)
+            responses.append(response)
+    return responses
+
+def legacy_listing(tn):
+    tn.write("stats --users\r\n")
+    idx, obj, response = tn.expect([r'jcli :'], 600)
+    return jasmin_get.get_list_ids(response)
+
+def new_stats(tn, commands):
+    return jasmin_get.wait_for_prompts(tn, commands)
+
+def new_listing(tn):
+    tn.write("stats --users\r\n")
+    return jasmin_get.get_list_ids(tn.read_lines(to = 600))
+
+def bench(fn, *args):
+    t = time.time()
+    result = fn(*args)
+    return time.time() - t, result
+
+def main():
+    api_keys = sorted(set(k for key in jasmin_get.keys if type(key) == dict
+        for table in ['smppsapi', 'httpapi'] if table in key for k in key[table]))
+
+    print '%-8s %8s %12s %12s %8s' % ('test', 'users', 'legacy (s)', 'new (s)', 'speedup')
+    for users in args.users:
+        server = fakes.FakeJcli(users, 1, api_keys).start()
+        jasmin_get.jcli['port'] = server.port
+        legacy = legacy_session()
+        new, version = jasmin_get.jcli_connect(jasmin_get.jcli['host'], server.port,
+            jasmin_get.jcli['username'], jasmin_get.jcli['password'])
+
+        commands = ["stats --user user%d\r\n" % i for i in range(users)]
+        l, legacy_responses = bench(legacy_stats, legacy, commands)
+        n, new_responses = bench(new_stats, new, commands)
+        # Both readers must agree before being compared
+        assert [jasmin_get.parse_stats(r) for r in legacy_responses] == [jasmin_get.parse_stats(r) for r in new_responses]
+        print '%-8s %8d %12.3f %12.3f %7.1fx' % ('stats', users, l, n, l / n)
+
+        l, legacy_ids = bench(legacy_listing, legacy)
+        n, new_ids = bench(new_listing, new)
+        assert legacy_ids == new_ids
+        print '%-8s %8d %12.3f %12.3f %7.1fx' % ('listing', users, l, n, l / n)
+
+        legacy.close()
+        new.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# Benchmark of metrics building and trapper payload serialization in zabbix_common.py
+# Compares the former list of Metric objects serialized with json.dumps() per field
+# with MetricBatch, for time and peak memory (RSS) as the number of items grows
+
+import os, sys, json, time, argparse, resource, subprocess
+
+parser = argparse.ArgumentParser(description='Metric batch benchmark')
+parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000, 100000], help = "Number of metrics")
+parser.add_argument('--run', nargs=2, metavar=('IMPL', 'ITEMS'), help = argparse.SUPPRESS)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'common', 'script', 'common'))
+import zabbix_common
+
+def sample(count):
+    "(host, key, value) of 'count' user metrics, as collected from jCli"
+    for i in xrange(count):
+        yield ('benchmark', 'jasmin[user.smppsapi.submit_sm_count,user%d]' % (i / 10), str(i))
+
+def legacy_build(count):
+    return [zabbix_common.Metric(h, k, v) for h, k, v in sample(count)]
+
+def legacy_payload(metrics):
+    "ZabbixSender's serialization as it was before MetricBatch"
+    j = json.dumps
+    metrics_data = []
+    for m in metrics:
+        clock = m.clock or ('%d' % time.time())
+        metrics_data.append(('{"host":%s,"key":%s,"value":%s,"clock":%s}') % (j(m.host), j(m.key), j(m.value), j(clock)))
+    return ','.join(metrics_data)
+
+def batch_build(count):
+    metrics = zabbix_common.MetricBatch()
+    for h, k, v in sample(count):
+        metrics.add(h, k, v)
+    return metrics
+
+def batch_payload(metrics):
+    return metrics.payload()
+
+impls = {'legacy': (legacy_build, legacy_payload), 'batch': (batch_build, batch_payload)}
+
+def run(impl, count):
+    "Build and serialize 'count' metrics, print build time, serialize time and peak RSS (KB)"
+    build, payload = impls[impl]
+    t = time.time()
+    metrics = build(count)
+    b = time.time() - t
+    t = time.time()
+    payload(metrics)
+    s = time.time() - t
+    print b, s, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def normalize(data):
+    return [dict(item, clock = int(item['clock'])) for item in json.loads('[%s]' % data)]
+
+def main():
+    if args.run is not None:
+        run(args.run[0], int(args.run[1]))
+        return
+
+    # Both must send the same items before being compared
+    assert normalize(legacy_payload(legacy_build(1000))) == normalize(str(batch_payload(batch_build(1000))))
+
+    # Each run in its own process for its peak RSS, baseline is the process with no metrics
+    def measure(impl, count):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', impl, str(count)])
+        return [float(v) for v in out.split()]
+    base = measure('legacy', 0)[2]
+
+    print '%-8s %8s %10s %12s %12s %8s' % ('impl', 'items', 'build (s)', 'serialize (s)', 'RSS (MB)', 'speedup')
+    for count in args.items:
+        l = measure('legacy', count)
+        for impl, r in [('legacy', l), ('batch', measure('batch', count))]:
+            print '%-8s %8d %10.3f %12.3f %12.1f %7.1fx' % (impl, count, r[0], r[1], (r[2] - base) / 1024,
+                (l[0] + l[1]) / (r[0] + r[1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# This a script that send metrics directly to Zabbix server
+# All metrics are gathered using Active agent.
+# It runs the Jasmin, RabbitMQ and Redis collectors in one resident process, each
+# one on its own interval, and sends their metrics through one shared queue
+
+import argparse, imp, os, shlex, signal, sys, threading, time, Queue
+from lockfile import FileLock, LockTimeout, AlreadyLocked
+
+# The script must not be executed simultaneously
+lock = FileLock("/tmp/zabbix_collector")
+
+parser = argparse.ArgumentParser(description='Zabbix Jasmin, RabbitMQ and Redis collector')
+parser.add_argument('--scripts-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    help = "Where jasmin/, rabbitmq/ and redis/ collector scripts are installed")
+parser.add_argument('--jasmin', metavar='ARGS', help = "Collect Jasmin metrics, with these jasmin_get.py arguments")
+parser.add_argument('--jasmin-interval', type=float, default=60, help = "Jasmin collection interval (seconds)")
+parser.add_argument('--rabbitmq', metavar='ARGS', help = "Collect RabbitMQ metrics, with these rabbitmq_get.py arguments")
+parser.add_argument('--rabbitmq-interval', type=float, default=60, help = "RabbitMQ collection interval (seconds)")
+parser.add_argument('--redis', metavar='ARGS', help = "Collect Redis metrics, with these redis_get.py arguments")
+parser.add_argument('--redis-interval', type=float, default=60, help = "Redis collection interval (seconds)")
+parser.add_argument('--zabbix-batch-size', type=int, default=250, help = "Maximum number of items per trapper packet")
+parser.add_argument('--zabbix-senders', type=int, default=1, help = "Number of concurrent connections to Zabbix trapper")
+parser.add_argument('--spool-dir', default='/tmp/zabbix_collector.spool', help = "Where metrics failing to reach Zabbix are kept for replay")
+parser.add_argument('--spool-size', type=int, default=64, help = "Maximum spool size in MB (0 to disable spooling)")
+parser.add_argument('--spool-replay', type=int, default=10000, help = "Maximum number of spooled metrics replayed per send")
+parser.add_argument('--delta', action='store_true', help = "Send changed values only (and all values every --heartbeat seconds)")
+parser.add_argument('--heartbeat', type=int, default=600, help = "Maximum age of a value in Zabbix in delta mode (seconds)")
+args = parser.parse_args()
+
+# Sender shared by the collector scripts, see script/common/
+sys.path.insert(0, os.path.join(args.scripts_dir, 'common'))
+from zabbix_common import ZabbixBatchSender, Spool, LastValueCache
+
+class Source(object):
+    """A collector run every 'interval' seconds in its own thread
+
+    open() returns the collector's state (jCli sessions, connections ...) given
+    to collect(), it is re-opened after any failure and released by close().
+    """
+
+    def __init__(self, name, interval, open, collect, close):
+        self.name = name
+        self.interval = interval
+        self.open = open
+        self.collect = collect
+        self.close = close
+
+def load_script(name, argv):
+    "Load <name>/<name>_get.py as a module, its module level arguments parsing being given argv"
+    path = os.path.join(args.scripts_dir, name, '%s_get.py' % name)
+    saved = sys.argv
+    sys.argv = [path] + shlex.split(argv)
+    try:
+        return imp.load_source('%s_get' % name, path)
+    finally:
+        sys.argv = saved
+
+def jasmin_source(m):
+    "Jasmin collector, jCli sessions of every node are kept open between cycles"
+    rates = m.RateCalculator(m.is_counter, m.args.rates) if m.args.rates != 'none' else None
+    nodes = m.build_nodes(args.jasmin_interval / 2, persist = False)
+
+    def _close(nodes):
+        for node in nodes:
+            node.close()
+
+    # The shared sender's stats cover every source's metrics, they are not reported
+    # as Jasmin's. A failed node is re-opened by collect_cycle() itself
+    return Source('jasmin', args.jasmin_interval, lambda: nodes,
+        lambda nodes: m.collect_cycle(nodes, None, rates), _close)
+
+def rabbitmq_source(m):
+    "RabbitMQ collector, management API connections are kept alive between cycles"
+    selector = m.QueueSelector(m.queues_selection, m.args.top, m.args.top_by, m.thresholds, m.args.hold)
+    rates = m.RateCalculator(m.is_counter, m.args.rates) if m.args.rates != 'none' else None
+
+    def _open():
+        return m.ManagementClient(m.rabbitmq['host'], m.rabbitmq['port'], m.rabbitmq['username'],
+            m.rabbitmq['password'])
+
+    return Source('rabbitmq', args.rabbitmq_interval, _open,
+        lambda client: m.collect(client, selector, rates), lambda client: client.close())
+
+def redis_source(m):
+    "Redis collector, one connection per instance is kept open between cycles"
+    def _open():
+        return dict((name, m.RedisClient(address, port, m.redis['password']))
+            for name, (address, port) in m.redis['instances'].items())
+
+    def _close(clients):
+        for client in clients.values():
+            client.close()
+
+    return Source('redis', args.redis_interval, _open, m.collect_instances, _close)
+
+def run_source(source, pending, stopping):
+    "Collect from source every 'source.interval' seconds and queue its metrics, until stopping is set"
+    state = None
+    next_run = time.time()
+    while not stopping.is_set():
+        try:
+            if state is None:
+                state = source.open()
+            pending.put(source.collect(state))
+        except Exception, e:
+            # State is unknown: drop it and re-open it on next cycle
+            print '%s: %s' % (source.name, type(e))
+            print '%s: Error: %s' % (source.name, e)
+            if state is not None:
+                try:
+                    source.close(state)
+                except Exception:
+                    pass
+                state = None
+        sys.stdout.flush()
+
+        next_run += source.interval
+        delay = next_run - time.time()
+        if delay < 0:
+            # Cycle overran its interval, do not try to catch up
+            next_run = time.time()
+            delay = 0
+        stopping.wait(delay)
+
+    if state is not None:
+        source.close(state)
+
+def run_sender(sender, pending, stopping):
+    "Send queued metrics to Zabbix until stopping is set and the queue is empty"
+    while not stopping.is_set() or not pending.empty():
+        try:
+            metrics = pending.get(timeout = 1)
+        except Queue.Empty:
+            continue
+        # Metrics of sources done meanwhile go in the same packets
+        while True:
+            try:
+                metrics.extend(pending.get_nowait())
+            except Queue.Empty:
+                break
+        sender.send(metrics)
+        sys.stdout.flush()
+
+def main():
+    names = [name for name in ['jasmin', 'rabbitmq', 'redis'] if getattr(args, name) is not None]
+    if len(names) == 0:
+        parser.error('at least one of --jasmin, --rabbitmq or --redis is required')
+    modules = dict((name, load_script(name, getattr(args, name))) for name in names)
+
+    # Zabbix server is the one configured in the first collector script
+    m = modules[names[0]]
+    sender = ZabbixBatchSender(m.zabbix_host, m.zabbix_port, batch_size = args.zabbix_batch_size,
+        concurrency = args.zabbix_senders,
+        spool = Spool(args.spool_dir, args.spool_size * 1024 * 1024, args.spool_replay) if args.spool_size > 0 else None,
+        cache = LastValueCache(None, args.heartbeat) if args.delta else None)
+
+    sources = []
+    if 'jasmin' in modules:
+        sources.append(jasmin_source(modules['jasmin']))
+    if 'rabbitmq' in modules:
+        sources.append(rabbitmq_source(modules['rabbitmq']))
+    if 'redis' in modules:
+        sources.append(redis_source(modules['redis']))
+
+    pending = Queue.Queue()
+    stopping = threading.Event()
+    threads = []
+    # Exit through finally clauses (closing sessions and releasing the lock) when stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # Ensure there are no paralell runs of this script
+        lock.acquire(timeout=5)
+
+        threads.append(threading.Thread(target = run_sender, args = (sender, pending, stopping)))
+        for source in sources:
+            threads.append(threading.Thread(target = run_source, args = (source, pending, stopping)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Signals are only handled by the main thread, while it is not blocked in join()
+        while True:
+            time.sleep(1)
+    except LockTimeout:
+        print 'Lock not acquired, exiting'
+    except AlreadyLocked:
+        print 'Already locked, exiting'
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception, e:
+        print type(e)
+        print 'Error: %s' % e
+    finally:
+        stopping.set()
+        for thread in threads:
+            thread.join(60)
+        sender.close()
+
+        # Release the lock
+        if lock.i_am_locking():
+            lock.release()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,768 @@
+# Shared by the collector scripts: metrics batches and their sending to Zabbix
+# trapper (spooling, delta and rates), runs exclusion
+
+import json, struct, time, re, socket, errno, Queue, threading, os, zlib, signal, fcntl
+from contextlib import contextmanager
+from array import array
+
+class Metric(object):
+    def __init__(self, host, key, value, clock=None):
+        self.host = host
+        self.key = key
+        self.value = value
+        self.clock = clock
+
+    def __repr__(self):
+        result = None
+        if self.clock is None:
+            result = 'Metric(%r, %r, %r)' % (self.host, self.key, self.value)
+        else:
+            result = 'Metric(%r, %r, %r, %r)' % (self.host, self.key, self.value, self.clock)
+        return result
+
+class StringTable(object):
+    "Interned strings (hosts or keys) of metric batches, with their JSON encoding"
+    __slots__ = ('ids', 'names', 'encoded')
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.encoded = []
+
+    def id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.encoded.append(json.dumps(name))
+        return i
+
+# Strings needing no JSON escaping
+plain_string_re = re.compile(r'[ !#-\[\]-~]*\Z')
+
+def encode_value(value):
+    "JSON encode value, skipping json.dumps() for integers and plain strings"
+    t = type(value)
+    if t is int or t is long:
+        return str(value)
+    elif t is str and plain_string_re.match(value):
+        return '"%s"' % value
+    return json.dumps(value)
+
+class MetricBatch(object):
+    """A compact list of metrics
+
+    Hosts and keys are interned in tables shared with the batch's slices and JSON
+    encoded once per table entry, values and clocks are held in columns. Iterating
+    a batch gives Metric objects so it can be used wherever a list of metrics is,
+    payload() serializes it without any per-metric object.
+    """
+    __slots__ = ('hosts', 'keys', 'host_ids', 'key_ids', 'values', 'clocks')
+
+    def __init__(self, hosts = None, keys = None):
+        self.hosts = hosts if hosts is not None else StringTable()
+        self.keys = keys if keys is not None else StringTable()
+        self.host_ids = array('I')
+        self.key_ids = array('I')
+        self.values = []
+        # 0 when metric has no clock, it is sent with the current time
+        self.clocks = array('l')
+
+    def add(self, host, key, value, clock = None):
+        # Table lookups are inlined, this is called for every collected metric
+        i = self.hosts.ids.get(host)
+        self.host_ids.append(i if i is not None else self.hosts.id(host))
+        i = self.keys.ids.get(key)
+        self.key_ids.append(i if i is not None else self.keys.id(key))
+        self.values.append(value)
+        self.clocks.append(int(float(clock)) if clock else 0)
+
+    def append(self, metric):
+        self.add(metric.host, metric.key, metric.value, metric.clock)
+
+    def extend(self, metrics):
+        if isinstance(metrics, MetricBatch) and metrics.hosts is self.hosts and metrics.keys is self.keys:
+            self.host_ids.extend(metrics.host_ids)
+            self.key_ids.extend(metrics.key_ids)
+            self.values.extend(metrics.values)
+            self.clocks.extend(metrics.clocks)
+        else:
+            for m in metrics:
+                self.append(m)
+
+    def stamp(self, clock):
+        "Give metrics without a clock this one"
+        clock = int(clock)
+        for i in xrange(len(self.clocks)):
+            if not self.clocks[i]:
+                self.clocks[i] = clock
+
+    def split_hosts(self):
+        "Return {host: batch of its metrics}, batches share this batch's tables"
+        if len(self.host_ids) == 0:
+            return {}
+        if min(self.host_ids) == max(self.host_ids):
+            return {self.hosts.names[self.host_ids[0]]: self}
+
+        batches = {}
+        for h in set(self.host_ids):
+            indexes = [i for i, x in enumerate(self.host_ids) if x == h]
+            batch = batches[self.hosts.names[h]] = MetricBatch(self.hosts, self.keys)
+            batch.host_ids = array('I', [h]) * len(indexes)
+            batch.key_ids = array('I', [self.key_ids[i] for i in indexes])
+            batch.values = [self.values[i] for i in indexes]
+            batch.clocks = array('l', [self.clocks[i] for i in indexes])
+        return batches
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            batch = MetricBatch(self.hosts, self.keys)
+            batch.host_ids = self.host_ids[i]
+            batch.key_ids = self.key_ids[i]
+            batch.values = self.values[i]
+            batch.clocks = self.clocks[i]
+            return batch
+        return Metric(self.hosts.names[self.host_ids[i]], self.keys.names[self.key_ids[i]], self.values[i],
+            self.clocks[i] or None)
+
+    def __iter__(self):
+        for i in xrange(len(self.values)):
+            yield self[i]
+
+    def payload(self):
+        "Serialize metrics into the items of a trapper request's data array, in one growing buffer"
+        now = '%d' % time.time()
+        hosts = self.hosts.encoded
+        keys = self.keys.encoded
+        buf = bytearray()
+        sep = ''
+        for h, k, value, clock in zip(self.host_ids, self.key_ids, self.values, self.clocks):
+            buf += '%s{"host":%s,"key":%s,"value":%s,"clock":%s}' % (sep, hosts[h], keys[k], encode_value(value),
+                '%d' % clock if clock else now)
+            sep = ','
+        return buf
+
+def parse_zabbix_info(info):
+    """Parse trapper's response info, e.g. "processed: 2; failed: 0; total: 2; seconds spent: 0.000055"
+
+    Will return a dict or None if info cannot be parsed
+    """
+    m = re.search(r'processed:?\s*(\d+);?\s*failed:?\s*(\d+);?\s*total:?\s*(\d+);?\s*seconds spent:?\s*([0-9.]+)',
+        info or '', re.IGNORECASE)
+    if not m:
+        return None
+    return {'processed': int(m.group(1)), 'failed': int(m.group(2)), 'total': int(m.group(3)),
+        'seconds_spent': float(m.group(4))}
+
+class ZabbixSender(object):
+    """A reusable connection to Zabbix trapper
+
+    The connection is kept open across send() calls when the server permits it,
+    otherwise it is re-opened with an exponential backoff between failed attempts.
+    Metrics are serialized through a MetricBatch, its payload is streamed in
+    chunks of 'chunk_size' bytes.
+    """
+
+    def __init__(self, zabbix_host='127.0.0.1', zabbix_port=10051, timeout=120,
+        chunk_size=65536, retries=3, backoff=0.5, max_backoff=30):
+        self.zabbix_host = zabbix_host
+        self.zabbix_port = zabbix_port
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sock = None
+        # Parsed info of last response, see parse_zabbix_info()
+        self.last_info = None
+        # Outcome of last send: 'accepted', 'rejected' (by the server, sending the
+        # same metrics again would not help), 'failed' or 'unreachable'
+        self.last_status = None
+        # Seconds spent serializing last payload
+        self.last_serialize = 0
+
+    def _connect(self):
+        delay = self.backoff
+        for attempt in range(self.retries):
+            try:
+                self.sock = socket.create_connection((self.zabbix_host, self.zabbix_port), self.timeout)
+                # Packet header and tail are small writes of their own, do not let Nagle's
+                # algorithm hold them until the server acknowledges the previous chunk
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return
+            except socket.error:
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def _is_alive(self):
+        "Check if the server kept the connection open after the last response"
+        if self.sock is None:
+            return False
+
+        try:
+            self.sock.setblocking(0)
+            # Either closed by server ('') or unexpected data, both mean it cannot be reused
+            self.sock.recv(1, socket.MSG_PEEK)
+            return False
+        except socket.error, e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def _stream(self, payload):
+        head = '{"request":"sender data","data":['
+        tail = ']}'
+        data_len = len(head) + len(payload) + len(tail)
+
+        # For debug:
+        #print(data_len)
+
+        self.sock.sendall('ZBXD\x01' + struct.pack('<Q', data_len) + head)
+        view = memoryview(payload)
+        for i in range(0, len(payload), self.chunk_size):
+            self.sock.sendall(view[i:i + self.chunk_size])
+        self.sock.sendall(tail)
+
+    def send(self, metrics):
+        "Send metrics to Zabbix, return True if they were accepted"
+        result = None
+        self.last_info = None
+        self.last_status = 'unreachable'
+        t = time.time()
+        if not hasattr(metrics, 'payload'):
+            batch = MetricBatch()
+            batch.extend(metrics)
+            metrics = batch
+        payload = metrics.payload()
+        self.last_serialize = time.time() - t
+
+        try:
+            for attempt in range(2):
+                reused = self._is_alive()
+                if not reused:
+                    self.close()
+                    self._connect()
+                self.last_status = 'failed'
+
+                try:
+                    self._stream(payload)
+                    resp_hdr = _recv_all(self.sock, 13)
+                except socket.error:
+                    if not reused:
+                        raise
+                    resp_hdr = ''
+                if resp_hdr or not reused:
+                    break
+                # Server dropped the kept-alive connection meanwhile, retry on a new one
+                self.close()
+
+            if not resp_hdr.startswith('ZBXD\x01') or len(resp_hdr) != 13:
+                print('Wrong zabbix response')
+                self.close()
+                result = False
+            else:
+                resp_body_len = struct.unpack('<Q', resp_hdr[5:])[0]
+                resp_body = _recv_all(self.sock, resp_body_len)
+
+                resp = json.loads(resp_body)
+                self.last_info = parse_zabbix_info(resp.get('info'))
+                # For debug
+                # print(resp)
+                if resp.get('response') == 'success':
+                    self.last_status = 'accepted'
+                    result = True
+                else:
+                    print('Got error from Zabbix: %s' % resp)
+                    self.last_status = 'rejected'
+                    result = False
+        except Exception, e:
+            print('Error while sending data to Zabbix: %s' % e)
+            self.close()
+            result = False
+        finally:
+            return result
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class Spool(object):
+    """An on-disk spool of metrics that could not be sent to Zabbix
+
+    Every spooled batch is written once to its own segment file (zlib compressed
+    JSON, metrics keep their original clock) named after a sequence number.
+    Segments are replayed oldest first, up to 'max_replay' metrics per replay(),
+    and the oldest ones are evicted when the spool grows over 'max_size' bytes.
+    A segment still failing after 'max_attempts' replays reaching Zabbix is
+    dropped, it would otherwise hold newer segments back.
+    """
+
+    def __init__(self, path, max_size, max_replay = 10000, max_attempts = 5):
+        self.path = path
+        self.max_size = max_size
+        self.max_replay = max_replay
+        self.max_attempts = max_attempts
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _segments(self):
+        return sorted(f for f in os.listdir(self.path) if f.endswith('.seg'))
+
+    def _write(self, name, metrics, attempts = 0):
+        "Atomically (re)write segment 'name', 'attempts' being its failed replays count"
+        now = '%d' % time.time()
+        data = zlib.compress(json.dumps({'attempts': attempts,
+            'metrics': [[m.host, m.key, m.value, m.clock or now] for m in metrics]}))
+        with open(name + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(name + '.tmp', name)
+
+    def append(self, metrics):
+        if len(metrics) == 0:
+            return
+
+        segments = self._segments()
+        seq = int(segments[-1].split('.')[0]) + 1 if len(segments) > 0 else 0
+        self._write(os.path.join(self.path, '%016d.seg' % seq), metrics)
+
+        # Evict oldest segments
+        sizes = [os.path.getsize(os.path.join(self.path, s)) for s in segments + ['%016d.seg' % seq]]
+        total = sum(sizes)
+        for s, size in zip(segments, sizes):
+            if total <= self.max_size:
+                break
+            print 'Spool is full, dropping segment %s' % s
+            os.remove(os.path.join(self.path, s))
+            total -= size
+
+    def replay(self, send):
+        """Send spooled segments oldest first through 'send', stop at the first
+        failure or once 'max_replay' metrics were sent
+
+        'send' is given a list of metrics and must return the list of failed
+        batches and whether Zabbix was reached.
+        Will return False if Zabbix could not be reached
+        """
+        replayed = 0
+        for s in self._segments():
+            if replayed >= self.max_replay:
+                # What is left is replayed on next calls
+                break
+            name = os.path.join(self.path, s)
+            try:
+                with open(name, 'rb') as f:
+                    segment = json.loads(zlib.decompress(f.read()))
+                if type(segment) == list:
+                    # Written before segments had an attempts count
+                    segment = {'attempts': 0, 'metrics': segment}
+                metrics = [Metric(*m) for m in segment['metrics']]
+            except (ValueError, TypeError, KeyError, zlib.error), e:
+                print 'Dropping corrupted spool segment %s: %s' % (s, e)
+                os.remove(name)
+                continue
+
+            failed, reached = send(metrics)
+            replayed += len(metrics)
+            if len(failed) == 0:
+                os.remove(name)
+            elif not reached:
+                # Zabbix is still down, it does not count as an attempt
+                self._write(name, [m for batch in failed for m in batch], segment['attempts'])
+                return False
+            elif segment['attempts'] + 1 >= self.max_attempts:
+                print 'Dropping spool segment %s after %d failed attempts' % (s, segment['attempts'] + 1)
+                os.remove(name)
+            else:
+                # Keep only what was not accepted
+                self._write(name, [m for batch in failed for m in batch], segment['attempts'] + 1)
+                return True
+
+        return True
+
+class LastValueCache(object):
+    """Last sent value of every (host, key), used to send changed values only
+
+    A metric is filtered out while its value is unchanged and it was sent less
+    than 'heartbeat' seconds ago. Values only count as sent once committed, after
+    Zabbix accepted them. The cache is persisted to 'path' between runs, or only
+    held in memory if 'path' is None.
+    """
+
+    def __init__(self, path = None, heartbeat = 600):
+        self.path = path
+        self.heartbeat = heartbeat
+        self.values = {}
+        self.suppressed = 0
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.values = json.load(f)
+            except ValueError, e:
+                print 'Ignoring corrupted cache %s: %s' % (path, e)
+
+    def filter(self, metrics):
+        "Return metrics to be sent, see commit()"
+        now = time.time()
+        changed = MetricBatch()
+        for m in metrics:
+            last = self.values.get(m.host, {}).get(m.key)
+            if last is not None and last[0] == m.value and now - last[1] < self.heartbeat:
+                continue
+            changed.append(m)
+        self.suppressed = len(metrics) - len(changed)
+
+        return changed
+
+    def commit(self, metrics):
+        "Remember metrics as sent"
+        now = time.time()
+        for m in metrics:
+            self.values.setdefault(m.host, {})[m.key] = [m.value, now]
+
+        if self.path is not None:
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump(self.values, f)
+            os.rename(self.path + '.tmp', self.path)
+
+class RateCalculator(object):
+    """Turn cumulative counters into per-second rates
+
+    The previous sample of every counter (as told by 'is_counter') is kept and
+    persisted to 'path' between runs, or only held in memory if 'path' is None.
+    In 'replace' mode counters are replaced by their rate under the same key, in
+    'both' mode rates are added under rate_key(key). A counter going backwards
+    (e.g. after a restart) is counted from zero. Nothing is sent for a counter
+    until it has a previous sample.
+    """
+
+    def __init__(self, is_counter, mode = 'replace', path = None):
+        self.is_counter = is_counter
+        self.mode = mode
+        self.path = path
+        self.samples = {}
+        self.resets = 0
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.samples = json.load(f)
+            except ValueError, e:
+                print 'Ignoring corrupted rates state %s: %s' % (path, e)
+
+    @staticmethod
+    def rate_key(key):
+        """jasmin[smppsapi.submit_sm_count] -> jasmin.rate[smppsapi.submit_sm_count],
+        rabbitmq.vhost.message_stats.publish -> rabbitmq.vhost.message_stats.publish.rate"""
+        i = key.find('[')
+        if i < 0:
+            return key + '.rate'
+        return key[:i] + '.rate' + key[i:]
+
+    def process(self, metrics):
+        "Return metrics with counters replaced by (or completed with) their rates"
+        now = time.time()
+        result = MetricBatch()
+        self.resets = 0
+        for m in metrics:
+            if not self.is_counter(m.key):
+                result.append(m)
+                continue
+            try:
+                value = float(m.value)
+            except (TypeError, ValueError):
+                result.append(m)
+                continue
+            clock = float(m.clock) if m.clock is not None else now
+
+            samples = self.samples.setdefault(m.host, {})
+            last = samples.get(m.key)
+            samples[m.key] = [value, clock]
+            if self.mode == 'both':
+                result.append(m)
+            if last is None or clock <= last[1]:
+                continue
+
+            delta = value - last[0]
+            if delta < 0:
+                # Counter was reset
+                self.resets += 1
+                delta = value
+            result.add(m.host, m.key if self.mode == 'replace' else self.rate_key(m.key),
+                '%.6f' % (delta / (clock - last[1])), m.clock)
+
+        if self.path is not None:
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump(self.samples, f)
+            os.rename(self.path + '.tmp', self.path)
+
+        return result
+
+class ZabbixBatchSender(object):
+    """Split metrics into batches of 'batch_size' items sent concurrently over
+    'concurrency' ZabbixSender connections
+
+    send() returns True only if every batch was accepted, trapper's info of every
+    batch is aggregated into 'stats', and per host into stats['hosts'] as every
+    batch holds a single host's metrics.
+    When a spool is set, its content is replayed before sending new metrics and
+    failed batches are appended to it, batches rejected by the server are not.
+    When a cache is set, new metrics are filtered through it first and the
+    accepted ones are committed to it.
+    """
+
+    def __init__(self, zabbix_host='127.0.0.1', zabbix_port=10051, batch_size=250, concurrency=1,
+        spool=None, cache=None, **kwargs):
+        self.batch_size = max(1, batch_size)
+        self.senders = [ZabbixSender(zabbix_host, zabbix_port, **kwargs) for i in range(max(1, concurrency))]
+        self.spool = spool
+        self.cache = cache
+        self.stats = None
+
+    def send(self, metrics):
+        "Send metrics to Zabbix, return True if all batches were accepted"
+        if self.cache is not None:
+            metrics = self.cache.filter(metrics)
+
+        if self.spool is not None and not self.spool.replay(self._replay):
+            # Zabbix is still failing, queue metrics behind spooled ones
+            self.spool.append(metrics)
+            return False
+
+        # Filtered metrics are a MetricBatch, accepted ones share its tables
+        accepted = MetricBatch(metrics.hosts, metrics.keys) if self.cache is not None else None
+        failed = self._send(metrics, accepted)
+        if self.spool is not None:
+            for batch in failed:
+                self.spool.append(batch)
+        if self.cache is not None:
+            self.cache.commit(accepted)
+
+        return len(failed) == 0 and self.stats['rejected_batches'] == 0
+
+    def _replay(self, metrics):
+        "Send spooled metrics, see Spool.replay()"
+        failed = self._send(metrics)
+        return failed, self.stats['unreachable_batches'] < self.stats['batches']
+
+    def _send(self, metrics, accepted = None):
+        """Send metrics to Zabbix, return the list of failed batches which were not
+        rejected by the server
+
+        Accepted metrics are added to 'accepted' if given
+        """
+        if not isinstance(metrics, MetricBatch):
+            batch = MetricBatch()
+            batch.extend(metrics)
+            metrics = batch
+        hosts = []
+        batches = []
+        for host, host_metrics in sorted(metrics.split_hosts().items()):
+            for i in range(0, len(host_metrics), self.batch_size):
+                hosts.append(host)
+                batches.append(host_metrics[i:i + self.batch_size])
+        statuses = [None] * len(batches)
+        infos = [None] * len(batches)
+        serializes = [0] * len(batches)
+        pending = Queue.Queue()
+        for i in range(len(batches)):
+            pending.put(i)
+
+        def _run(sender):
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                sender.send(batches[i])
+                statuses[i] = sender.last_status
+                infos[i] = sender.last_info
+                serializes[i] = sender.last_serialize
+
+        t = time.time()
+        threads = [threading.Thread(target = _run, args = (sender,)) for sender in self.senders[:len(batches)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.stats = {'clock': int(t), 'items': len(metrics), 'batches': len(batches),
+            'failed_batches': len(batches) - statuses.count('accepted'), 'rejected_batches': statuses.count('rejected'),
+            'unreachable_batches': statuses.count('unreachable'), 'processed': 0, 'failed': 0, 'total': 0,
+            'seconds_spent': 0.0, 'elapsed': time.time() - t, 'serialize': sum(serializes)}
+        self.stats['hosts'] = {}
+        for host, batch, info in zip(hosts, batches, infos):
+            per_host = self.stats['hosts'].setdefault(host, {'items': 0, 'processed': 0, 'failed': 0})
+            per_host['items'] += len(batch)
+            if info is not None:
+                for k in ['processed', 'failed', 'total', 'seconds_spent']:
+                    self.stats[k] += info[k]
+                per_host['processed'] += info['processed']
+                per_host['failed'] += info['failed']
+
+        if accepted is not None:
+            for batch, status in zip(batches, statuses):
+                if status == 'accepted':
+                    accepted.extend(batch)
+
+        return [batch for batch, status in zip(batches, statuses) if status in ('failed', 'unreachable')]
+
+    def close(self):
+        for sender in self.senders:
+            sender.close()
+
+class RunGuard(object):
+    """Overlap-aware exclusion of runs, e.g. started by cron
+
+    The run holding an exclusive flock on 'path' collects, the kernel releases it
+    if that run dies. A run started meanwhile does not wait for it: it is
+    coalesced, the running one collects once more when done instead of that
+    sample being lost. A running one whose current cycle started more than
+    'stale' seconds ago is deemed hung, it is terminated and replaced. A holder
+    waiting between two cycles (daemon mode) is never deemed hung.
+
+    Holder's pid, its cycle start and pending counts are kept in 'path'.state,
+    only read and written under a flock of its own.
+    """
+
+    def __init__(self, path, stale = 300):
+        self.path = path
+        self.stale = stale
+        self.fd = None
+
+    @contextmanager
+    def _state(self):
+        "Yield the shared state, locked until it is saved back"
+        with open(self.path + '.state', 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+
+    def _lock(self):
+        "Take the run lock if it is free, tell whether it was taken"
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        self.fd = fd
+        return True
+
+    def _unlock(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def acquire(self, wait = 5):
+        """Start a run, return True if it is to collect or False if it was
+        coalesced into the running one
+
+        A stale run is given 'wait' seconds to exit once terminated.
+        """
+        deadline = time.time() + wait
+        terminated = False
+        while True:
+            # The holder only releases the run lock under the state lock: a run
+            # counted as pending is always collected for
+            with self._state() as state:
+                if self._lock():
+                    state['pid'] = os.getpid()
+                    state['started'] = time.time()
+                    return True
+                age = time.time() - (state.get('started') or time.time())
+                if not terminated and age < self.stale:
+                    state['pending'] = state.get('pending', 0) + 1
+                    return False
+                elif not terminated:
+                    print 'Run %s is stale (cycle started %ds ago), terminating it' % (state.get('pid'), age)
+                    if state.get('pid'):
+                        try:
+                            os.kill(state['pid'], signal.SIGTERM)
+                        except OSError:
+                            pass
+                    state['stale'] = state.get('stale', 0) + 1
+                    terminated = True
+                elif time.time() >= deadline:
+                    print 'Stale run %s did not exit' % state.get('pid')
+                    state['pending'] = state.get('pending', 0) + 1
+                    return False
+            time.sleep(0.1)
+
+    def cycle(self):
+        """Start a cycle of the holding run, return the counts of runs coalesced
+        into it and of stale runs terminated since its previous cycle"""
+        with self._state() as state:
+            state['started'] = time.time()
+            return {'coalesced': state.pop('pending', 0), 'stale': state.pop('stale', 0)}
+
+    def done(self, keep = False):
+        """End a cycle of the holding run, return True if runs were coalesced
+        into it meanwhile (it is to collect again), release it otherwise unless
+        'keep' is set (daemon mode)"""
+        with self._state() as state:
+            state['started'] = None
+            if state.get('pending', 0) > 0 or keep:
+                return state.get('pending', 0) > 0
+            self._unlock()
+            return False
+
+    def release(self):
+        if self.fd is not None:
+            with self._state():
+                self._unlock()
+
+def _recv_all(sock, count):
+    buf = ''
+    while len(buf)<count:
+        chunk = sock.recv(count-len(buf))
+        if not chunk:
+            return buf
+        buf += chunk
+    return buf
+
+def fetch(calls, concurrency, deadline = None):
+    """Run independent calls (functions without arguments) concurrently
+
+    Will return their results in the same order as 'calls', or the raised
+    exception in place of the result of a failed call. Calls not done by
+    'deadline' are left running in the background and get a None result.
+    """
+    results = [None] * len(calls)
+    pending = Queue.Queue()
+    for i in range(len(calls)):
+        pending.put(i)
+
+    def _run():
+        while deadline is None or time.time() < deadline:
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = calls[i]()
+            except Exception, e:
+                results[i] = e
+
+    threads = [threading.Thread(target = _run) for i in range(min(max(1, concurrency), len(calls)))]
+    for thread in threads:
+        # Calls left behind must not keep the script from exiting
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+    return list(results)
@@ -3,7 +3,7 @@
 
 import json, struct, time, argparse, re, socket, sys
 from lockfile import FileLock, LockTimeout, AlreadyLocked
-from telnetlib import Telnet, IAC, DO, DONT, WILL, WONT, SB, SE, TTYPE
+from jasmin_jcli import read_discovery_cache, write_discovery_cache, get_list_ids, jcli_connect
 
 # The script must not be executed simultaneously
 lock = FileLock("/tmp/jasmin_discover")
@@ -11,6 +11,8 @@ lock = FileLock("/tmp/jasmin_discover")
 parser = argparse.ArgumentParser(description='Zabbix Jasmin LLD script')
 parser.add_argument('--hostname', required=True, help = "Jasmin's hostname (same configured in Zabbix hosts)")
 parser.add_argument('-d', required=True, help = "users or smppcs")
+parser.add_argument('--discovery-ttl', type=int, default=300,
+    help = "Maximum age of cached users and smppcs ids before listing them again (seconds)")
 args = parser.parse_args()
 
 # Configuration
@@ -18,6 +20,8 @@ jcli = {'host': args.hostname, # Must be the same configured in Zabbix hosts !
         'port': 8990,
         'username': 'jcliadmin',
         'password': 'jclipwd'}
+# Users and smppcs ids, shared between jasmin_get.py and jasmin_discover.py
+discovery_cache = '/tmp/jasmin_discovery_%s.json' % jcli['host']
 
 # Discovery keys
 keys = []
@@ -25,56 +29,6 @@ keys.append('smppcs')
 keys.append('users')
 
 
-class jCliSessionError(Exception):
-    pass
-
-class jCliKeyError(Exception):
-    pass
-
-def process_option(tn, command, option):
-    if command == DO and option == TTYPE:
-        tn.sendall(IAC + WILL + TTYPE)
-        #print 'Sending terminal type "mypython"'
-        tn.sendall(IAC + SB + TTYPE + '\0' + 'mypython' + IAC + SE)
-    elif command in (DO, DONT):
-        #print 'Will', ord(option)
-        tn.sendall(IAC + WILL + option)
-    elif command in (WILL, WONT):
-        #print 'Do', ord(option)
-        tn.sendall(IAC + DO + option)
-
-def wait_for_prompt(tn, command = None, prompt = r'jcli :', to = 20):
-    """Will send 'command' (if set) and wait for prompt
-
-    Will raise an exception if 'prompt' is not obtained after 'to' seconds
-    """
-
-    if command is not None:
-        tn.write(command)
-
-    idx, obj, response = tn.expect([prompt], to)
-    if idx == -1:
-        if command is None:
-            raise jCliSessionError('Did not get prompt (%s)' % prompt)
-        else:
-            raise jCliSessionError('Did not get prompt (%s) for command (%s)' % (prompt, command))
-    else:
-        return response
-
-def get_list_ids(response):
-    "Parse response and get list IDs, otherwise raise a jCliKeyError"
-    p = r"^#([A-Za-z0-9_-]+)\s+"
-    matches = re.findall(p, response, re.MULTILINE)
-    ids = []
-    if len(matches) == 0:
-        raise jCliKeyError('Cannot extract ids from response %s' % response)
-
-    for o in matches:
-        if o not in ['Connector', 'User']:
-            ids.append(o)
-
-    return ids
-
 def main():
     tn = None
     outcome = None
@@ -82,40 +36,26 @@ def main():
         # Ensure there are no paralell runs of this script
         lock.acquire(timeout=5)
 
-        # Connect and authenticate
-        tn = Telnet(jcli['host'], jcli['port'])
-        tn.set_option_negotiation_callback(process_option)
-
-        # for telnet session debug:
-        #tn.set_debuglevel(1000)
-
-        tn.read_until('Authentication required', 16)
-        tn.write("\r\n")
-        tn.read_until("Username:", 16)
-        tn.write(jcli['username']+"\r\n")
-        tn.read_until("Password:", 16)
-        tn.write(jcli['password']+"\r\n")
-
-        # We must be connected
-        idx, obj, response = tn.expect([r'Welcome to Jasmin ([0-9a-z\.]+) console'], 16)
-        if idx == -1:
-            raise jCliSessionError('Authentication failure')
+        # Serve ids from discovery cache when it is fresh enough
+        ids = read_discovery_cache(discovery_cache, args.discovery_ttl).get(args.d)
+        if ids is None and args.d in keys:
+            # Connect and authenticate
+            tn, version = jcli_connect(jcli['host'], jcli['port'], jcli['username'], jcli['password'])
 
-        # Wait for prompt
-        wait_for_prompt(tn)
+            # Listing may be large, parse it as it arrives
+            command = "stats --%s\r\n" % args.d
+            tn.write(command)
+            ids = get_list_ids(tn.read_lines(command = command))
+            write_discovery_cache(discovery_cache, args.d, ids)
 
         # Build outcome for requested key
         if args.d == 'smppcs':
-            response = wait_for_prompt(tn, command = "stats --smppcs\r\n")
-            smppcs = get_list_ids(response)
             outcome = {'data': []}
-            for cid in smppcs:
+            for cid in ids:
                 outcome['data'].append({'{#CID}': cid})
         elif args.d == 'users':
-            response = wait_for_prompt(tn, command = "stats --users\r\n")
-            users = get_list_ids(response)
             outcome = {'data': []}
-            for uid in users:
+            for uid in ids:
                 outcome['data'].append({'{#UID}': uid})
     except LockTimeout:
         print 'Lock not acquired, exiting'
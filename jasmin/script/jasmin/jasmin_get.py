@@ -3,16 +3,57 @@
 # All metrics are gathered using Active agent.
 # Metrics are covering Jasmin stats (smpps, users, http ...)
 
-import json, struct, time, argparse, re, socket, sys
-from lockfile import FileLock, LockTimeout, AlreadyLocked
-from telnetlib import Telnet, IAC, DO, DONT, WILL, WONT, SB, SE, TTYPE, ECHO
+import json, struct, time, argparse, re, socket, sys, threading, os, signal
+from contextlib import contextmanager
 
-# The script must not be executed simultaneously
-lock = FileLock("/tmp/jasmin_get")
+# Shared modules: this script's own and script/common/ ones
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [script_dir, os.path.join(os.path.dirname(script_dir), 'common')]
+from zabbix_common import MetricBatch, ZabbixBatchSender, Spool, LastValueCache, RateCalculator, RunGuard, fetch
+from jasmin_jcli import (jCliDeadlineError, jCliKeyError, read_discovery_cache, write_discovery_cache,
+    wait_for_prompt, wait_for_prompts, response_lines, get_list_ids, get_list_rows, jcli_connect)
 
 parser = argparse.ArgumentParser(description='Zabbix Jasmin status script')
-parser.add_argument('--hostname', required=True, help = "Jasmin's hostname (same configured in Zabbix hosts)")
+parser.add_argument('--hostname', help = "Jasmin's hostname (same configured in Zabbix hosts)")
+parser.add_argument('--nodes', nargs='+', metavar='HOSTNAME=ADDRESS[:PORT]',
+    help = "Jasmin nodes to collect from one host, as their Zabbix hostname and jCli endpoint (default: --hostname)")
+parser.add_argument('--node-concurrency', type=int, default=8, help = "Number of Jasmin nodes collected concurrently")
+parser.add_argument('--node-timeout', type=float, default=120,
+    help = "Maximum time spent collecting a node (seconds), a node still busy is given up for this cycle")
+parser.add_argument('--batch-size', type=int, default=50,
+    help = "Number of jCli stats commands pipelined in one round-trip (1 to disable pipelining)")
+parser.add_argument('--sessions', type=int, default=1,
+    help = "Number of parallel jCli sessions used for per-user and per-connector stats")
+parser.add_argument('--timing', action='store_true', help = "Print per-session timing")
+parser.add_argument('--daemon', action='store_true',
+    help = "Keep running and collect every --interval seconds instead of once")
+parser.add_argument('--interval', type=float, default=60, help = "Collection interval in daemon mode (seconds)")
+parser.add_argument('--zabbix-batch-size', type=int, default=250, help = "Maximum number of items per trapper packet")
+parser.add_argument('--zabbix-senders', type=int, default=1, help = "Number of concurrent connections to Zabbix trapper")
+parser.add_argument('--spool-dir', default='/tmp/jasmin_get.spool', help = "Where metrics failing to reach Zabbix are kept for replay")
+parser.add_argument('--spool-size', type=int, default=64, help = "Maximum spool size in MB (0 to disable spooling)")
+parser.add_argument('--spool-replay', type=int, default=10000, help = "Maximum number of spooled metrics replayed per cycle")
+parser.add_argument('--delta', action='store_true', help = "Send changed values only (and all values every --heartbeat seconds)")
+parser.add_argument('--heartbeat', type=int, default=600, help = "Maximum age of a value in Zabbix in delta mode (seconds)")
+parser.add_argument('--delta-cache', default='/tmp/jasmin_get.cache', help = "Where last sent values are kept between runs in delta mode")
+parser.add_argument('--discovery-ttl', type=int, default=300,
+    help = "Maximum age of cached users and smppcs ids before listing them again (seconds)")
+parser.add_argument('--rates', choices=['none', 'replace', 'both'], default='none',
+    help = "Send counters as per-second rates (replace) or rates along with counters (both)")
+parser.add_argument('--rates-state', default='/tmp/jasmin_get.rates', help = "Where last counter samples are kept between runs")
+parser.add_argument('--adaptive', action='store_true',
+    help = "Poll active users and smppcs every cycle and quiet ones less often (see --quiet-interval and --max-interval)")
+parser.add_argument('--quiet-interval', type=int, default=120,
+    help = "Polling interval of a user or smppc that turned quiet, doubled while it stays quiet (seconds)")
+parser.add_argument('--max-interval', type=int, default=900, help = "Maximum polling interval of a quiet user or smppc (seconds)")
+parser.add_argument('--tiers-state', default='/tmp/jasmin_get.tiers', help = "Where users and smppcs polling tiers are kept between runs")
+parser.add_argument('--budget', type=float, default=50,
+    help = "Maximum duration of a collection (seconds), it is then cut short and what was collected is sent")
+parser.add_argument('--stale', type=int, default=300,
+    help = "Age of a running collection after which it is deemed hung and terminated by the next run (seconds)")
 args = parser.parse_args()
+if args.hostname is None and not args.nodes:
+    parser.error('--hostname or --nodes is required')
 
 # Configuration
 zabbix_host = 'monitoring.jookies.net'  # Zabbix Server IP
@@ -21,6 +62,20 @@ jcli = {'host': args.hostname, # Must be the same configured in Zabbix hosts !
         'port': 8990,
         'username': 'jcliadmin',
         'password': 'jclipwd'}
+# Jasmin nodes as hostname: (address, port), metrics of each node are sent under its hostname
+jcli['nodes'] = {args.hostname: (args.hostname, jcli['port'])}
+if args.nodes:
+    jcli['nodes'] = {}
+    for node in args.nodes:
+        hostname, sep, endpoint = node.partition('=')
+        address, sep, port = (endpoint or hostname).partition(':')
+        jcli['nodes'][hostname] = (address, int(port or jcli['port']))
+# Users and smppcs ids of a node (by hostname), shared between jasmin_get.py and jasmin_discover.py
+discovery_cache = '/tmp/jasmin_discovery_%s.json'
+# Last send stats, reported in next run's self-monitoring metrics
+send_stats_file = '/tmp/jasmin_get.stats'
+# Runs exclusion (the script must not be executed simultaneously), see RunGuard
+run_guard = '/tmp/jasmin_get.run'
 
 # Monitoring keys
 keys = []
@@ -87,253 +142,619 @@ keys.append({'smppcs': [
     'data_sm_count',
     'submit_sm_request_count',
 ]})
+# *_count keys that are not cumulative counters, they are never turned into rates
+gauges = [
+    'smppsapi.bound_rx_count',
+    'smppsapi.bound_tx_count',
+    'smppsapi.bound_trx_count',
+    'smppsapi.connected_count',
+    'smppc.bound_count',
+    'user.smppsapi.bind_count',
+    'user.smppsapi.unbind_count',
+    'user.smppsapi.bound_tx_count',
+    'user.smppsapi.bound_rx_count',
+    'user.smppsapi.bound_trx_count',
+]
+
+# Stats telling a user or smppc is active when they change, see PollScheduler
+activity = {
+    'users': [
+        ('submit_sm_count', 'SMPP Server'),
+        ('deliver_sm_count', 'SMPP Server'),
+        ('bound_connections_count', 'SMPP Server'),
+        ('submit_sm_request_count', 'HTTP Api'),
+    ],
+    'smppcs': [
+        ('submit_sm_count', None),
+        ('deliver_sm_count', None),
+        ('bound_count', None),
+    ],
+}
+
+def is_counter(key):
+    "Tell whether key (e.g. jasmin[smppc.submit_sm_count,cid]) is a cumulative counter"
+    if not key.startswith('jasmin['):
+        return False
+    name = key[len('jasmin['):].split(',')[0].rstrip(']')
+    return name.endswith('_count') and name not in gauges
+
+class PhaseTimer(object):
+    "Accumulate durations and counters of collection phases, see collector_metrics()"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.durations = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.time() - t
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+class PollScheduler(object):
+    """Adaptive polling tiers of users and smppcs
+
+    An entity is polled every cycle while its activity stats (see 'activity')
+    change between polls. Once they stop changing, it is polled every 'quiet'
+    seconds, this interval doubling at every unchanged poll up to 'cap' seconds.
+    Its row in the cheap listing (e.g. 'stats --users'), checked every cycle,
+    changing in between promotes it back at once. 'slack' absorbs cycles starting
+    a bit early. Tiers are persisted to 'path' between runs, or only held in
+    memory if 'path' is None.
+    """
 
-class jCliSessionError(Exception):
-    pass
+    def __init__(self, quiet = 120, cap = 900, slack = 30, path = None):
+        self.quiet = quiet
+        self.cap = max(quiet, cap)
+        self.slack = slack
+        self.path = path
+        # {kind: {id: {'row', 'counters', 'interval', 'polled'}}}
+        self.entities = {}
+        # Listing rows of current cycle
+        self.rows = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.entities = json.load(f)
+            except ValueError, e:
+                print 'Ignoring corrupted tiers state %s: %s' % (path, e)
+
+    def due(self, kind, rows):
+        "Return ids of 'kind' ('users' or 'smppcs') to poll this cycle, given their listing rows [(id, row)]"
+        now = time.time()
+        self.rows[kind] = dict(rows)
+        entities = self.entities.setdefault(kind, {})
+        for i in entities.keys():
+            if i not in self.rows[kind]:
+                # Removed
+                del entities[i]
+
+        due = []
+        for i, row in rows:
+            e = entities.get(i)
+            if e is None or e['row'] != row or now - e['polled'] + self.slack >= e['interval']:
+                due.append(i)
+        return due
+
+    def polled(self, kind, i, counters):
+        "Record poll of entity i of 'kind' and its activity stats, updating its interval"
+        e = self.entities[kind].get(i)
+        row = self.rows[kind].get(i)
+        if e is None or e['counters'] != counters or e['row'] != row:
+            interval = 0
+        else:
+            interval = min(max(e['interval'] * 2, self.quiet), self.cap)
+        self.entities[kind][i] = {'row': row, 'counters': counters, 'interval': interval, 'polled': time.time()}
 
-class jCliKeyError(Exception):
-    pass
+    def save(self):
+        if self.path is not None:
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump(self.entities, f)
+            os.rename(self.path + '.tmp', self.path)
 
-class Metric(object):
-    def __init__(self, host, key, value, clock=None):
-        self.host = host
-        self.key = key
-        self.value = value
-        self.clock = clock
+# Precompiled pattern for parse_stats(): key, optional stat type and value of a table line
+stats_line_re = re.compile(r"^#(\S+)[ \t]+(?:(SMPP Server|HTTP Api)[ \t]+)?([^\r\n]*)", re.MULTILINE)
 
-    def __repr__(self):
-        result = None
-        if self.clock is None:
-            result = 'Metric(%r, %r, %r)' % (self.host, self.key, self.value)
-        else:
-            result = 'Metric(%r, %r, %r, %r)' % (self.host, self.key, self.value, self.clock)
-        return result
-
-def send_to_zabbix(metrics, zabbix_host='127.0.0.1', zabbix_port=10051):
-    result = None
-    j = json.dumps
-    metrics_data = []
-    for m in metrics:
-        clock = m.clock or ('%d' % time.time())
-        metrics_data.append(('{"host":%s,"key":%s,"value":%s,"clock":%s}') % (j(m.host), j(m.key), j(m.value), j(clock)))
-    json_data = ('{"request":"sender data","data":[%s]}') % (','.join(metrics_data))
-    data_len = struct.pack('<Q', len(json_data))
-    packet = 'ZBXD\x01'+ data_len + json_data
-
-    # For debug:
-    #print(packet)
-    #print(':'.join(x.encode('hex') for x in packet))
+def parse_stats(response):
+    """Parse a 'stats' response in one pass
 
-    try:
-        zabbix = socket.socket()
-        zabbix.settimeout(120)
-        zabbix.connect((zabbix_host, zabbix_port))
-        zabbix.sendall(packet)
-        resp_hdr = _recv_all(zabbix, 13)
-        if not resp_hdr.startswith('ZBXD\x01') or len(resp_hdr) != 13:
-            print('Wrong zabbix response')
-            result = False
-        else:
-            resp_body_len = struct.unpack('<Q', resp_hdr[5:])[0]
-            resp_body = zabbix.recv(resp_body_len)
-            zabbix.close()
-
-            resp = json.loads(resp_body)
-            # For debug
-            # print(resp)
-            if resp.get('response') == 'success':
-                result = True
-            else:
-                print('Got error from Zabbix: %s' % resp)
-                result = False
-    except Exception, e:
-        print('Error while sending data to Zabbix: %s' % e)
-        result = False
-    finally:
-        return result
-
-def _recv_all(sock, count):
-    buf = ''
-    while len(buf)<count:
-        chunk = sock.recv(count-len(buf))
-        if not chunk:
-            return buf
-        buf += chunk
-    return buf
-
-def process_option(tn, command, option):
-    if command == DO and option == TTYPE:
-        tn.sendall(IAC + WILL + TTYPE)
-        #print 'Sending terminal type "mypython"'
-        tn.sendall(IAC + SB + TTYPE + '\0' + 'mypython' + IAC + SE)
-    elif command in (DO, DONT):
-        #print 'Will', ord(option)
-        tn.sendall(IAC + WILL + option)
-    elif command in (WILL, WONT):
-        #print 'Do', ord(option)
-        tn.sendall(IAC + DO + option)
-
-def wait_for_prompt(tn, command = None, prompt = r'jcli :', to = 20):
-    """Will send 'command' (if set) and wait for prompt
-
-    Will raise an exception if 'prompt' is not obtained after 'to' seconds
+    Will return a dict of values keyed by (key, stat_type), stat_type being None
+    for untyped tables (smppc, smppsapi, httpapi)
     """
+    stats = {}
+    for key, stat_type, value in stats_line_re.findall(response):
+        stats[(key, stat_type or None)] = value.rstrip()
 
-    if command is not None:
-        tn.write(command)
+    return stats
 
-    idx, obj, response = tn.expect([prompt], to)
-    if idx == -1:
-        if command is None:
-            raise jCliSessionError('Did not get prompt (%s)' % prompt)
-        else:
-            raise jCliSessionError('Did not get prompt (%s) for command (%s)' % (prompt, command))
-    else:
-        return response
-
-def get_stats_value(response, key, stat_type = None):
-    "Parse response and get key's value, otherwise raise a jCliKeyError"
-    if stat_type is None:
-        p = r"#%s\s+([0-9A-Za-z -:'\{\}_]+)" % key
-    else:
-        p = r"#%s\s+%s\s+([0-9A-Za-z -:'\{\}_]+)" % (key, stat_type)
-
-    m = re.search(p, response, re.MULTILINE)
-    if not m:
+def get_stats_value(stats, key, stat_type = None):
+    "Get key's value from parse_stats() outcome, otherwise raise a jCliKeyError"
+    try:
+        return stats[(key, stat_type)]
+    except KeyError:
         raise jCliKeyError('Key (%s) not found !' % key)
-    else:
-        return m.group(1)
-
-def get_list_ids(response):
-    "Parse response and get list IDs, otherwise raise a jCliKeyError"
-    p = r"^#([A-Za-z0-9_-]+)\s+"
-    matches = re.findall(p, response, re.MULTILINE)
-    ids = []
-    if len(matches) == 0:
-        raise jCliKeyError('Cannot extract ids from response %s' % response)
-
-    for o in matches:
-        if o not in ['Connector', 'User']:
-            ids.append(o)
 
-    return ids
+# Precompiled pattern for get_smppcs_service_and_session()
+smppcs_line_re = re.compile(r"#([A-Za-z0-9_-]+)\s+(started|stopped)\s+([A-Za-z_]+)")
 
 def get_smppcs_service_and_session(response):
-    "Parse response and get Service and Session statuses for each smppc"
-    p = r"^#([A-Za-z0-9_-]+)\s+(started|stopped)\s+([A-Za-z_]+)"
-    matches = re.findall(p, response, re.MULTILINE)
-    r = {}
-    #if len(matches) == 0:
-    #    raise jCliKeyError('Cannot extract smppc service and session from response %s' % response)
+    """Parse response and get Service and Session statuses for each smppc
 
-    for o in matches:
-        if o not in ['Connector', 'User']:
-            r[o[0]] = {'service': o[1]}
-            r[o[0]]['session'] = o[2]
+    Response may be given as lines, they are parsed as they come.
+    """
+    r = {}
+    for line in response_lines(response):
+        m = smppcs_line_re.match(line)
+        if m is not None:
+            r[m.group(1)] = {'service': m.group(2), 'session': m.group(3)}
 
     return r
 
-def main():
-    tn = None
-    try:
-        # Ensure there are no paralell runs of this script
-        lock.acquire(timeout=5)
-
-        # Connect and authenticate
-        tn = Telnet(jcli['host'], jcli['port'])
+class jCliPool(object):
+    """A pool of authenticated jCli sessions
 
-        # for telnet session debug:
-        #tn.set_debuglevel(1000)
-
-        tn.set_option_negotiation_callback(process_option)
-
-
-        tn.read_until('Authentication required', 16)
-        tn.write("\r\n")
-        tn.read_until("Username:", 16)
-        tn.write(jcli['username']+"\r\n")
-        tn.read_until("Password:", 16)
-        tn.write(jcli['password']+"\r\n")
-
-        # We must be connected
-        idx, obj, response = tn.expect([r'Welcome to Jasmin ([0-9a-z\.]+) console'], 16)
-        if idx == -1:
-            raise jCliSessionError('Authentication failure')
-        version = obj.group(1)
+    Commands given to run() are spread across the sessions, each session is
+    driven by its own thread and pipelines its share of the commands. Sessions
+    are opened to address:port and give up by 'deadline' (see set_deadline()).
+    """
 
-        # Wait for prompt
-        wait_for_prompt(tn)
+    def __init__(self, size = 1, address = '127.0.0.1', port = 8990):
+        self.size = max(1, size)
+        self.address = address
+        self.port = port
+        self.deadline = None
+        self.sessions = []
+        self.version = None
+        # Per session: [login seconds, commands count, commands seconds]
+        self.timings = [[0, 0, 0] for i in range(self.size)]
+
+    def _spawn(self, target, args_list):
+        "Run target(*args) in one thread per args and re-raise the first error"
+        errors = []
+        def _run(*args):
+            try:
+                target(*args)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target = _run, args = a) for a in args_list]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def open(self):
+        "Open and authenticate all sessions concurrently"
+        self.sessions = [None] * self.size
+        versions = [None] * self.size
+        def _open(i):
+            t = time.time()
+            self.sessions[i], versions[i] = jcli_connect(self.address, self.port,
+                jcli['username'], jcli['password'], self.deadline)
+            self.timings[i][0] = time.time() - t
+
+        try:
+            self._spawn(_open, [(i,) for i in range(self.size)])
+        except Exception:
+            self.close()
+            raise
+        self.version = versions[0]
+
+    def run(self, commands, batch_size = 50):
+        """Spread commands across sessions and return responses in the
+        same order as 'commands'
+
+        Commands not answered by the deadline get a None response.
+        """
+        responses = [None] * len(commands)
+        def _run(i):
+            t = time.time()
+            # Session i gets commands i, i+size, i+2*size ...
+            received = []
+            try:
+                wait_for_prompts(self.sessions[i], commands[i::self.size], batch_size = batch_size,
+                    responses = received)
+            finally:
+                responses[i:i + len(received) * self.size:self.size] = received
+                self.timings[i][1] += len(received)
+                self.timings[i][2] += time.time() - t
+
+        try:
+            self._spawn(_run, [(i,) for i in range(self.size)])
+        except jCliDeadlineError:
+            pass
+        return responses
+
+    def set_deadline(self, deadline):
+        "Set when open() and commands give up, None for never"
+        self.deadline = deadline
+        for tn in self.sessions:
+            if tn is not None:
+                tn.deadline = deadline
+
+    def reset_timings(self):
+        "Reset commands timing, login timing is kept"
+        for timing in self.timings:
+            timing[1:] = [0, 0]
+
+    def close(self):
+        for tn in self.sessions:
+            if tn is not None and tn.get_socket():
+                tn.close()
+
+class Node(object):
+    """A Jasmin node collected through a jCliPool to address:port, its metrics
+    are sent under 'hostname' (same configured in Zabbix hosts)
+
+    The pool is opened on first collect_node() and kept until a failure, each
+    node has its own phases, discovery cache and polling tiers (if set).
+    """
 
-        # Build outcome for requested key
-        metrics = []
+    def __init__(self, hostname, address, port = 8990, tiers = None):
+        self.hostname = hostname
+        self.address = address
+        self.port = port
+        self.tiers = tiers
+        self.pool = None
+        self.phases = PhaseTimer()
+        self.discovery_cache = discovery_cache % hostname
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+def build_nodes(slack, persist = True):
+    """Return a Node for each of jcli['nodes'], sorted by hostname
+
+    With --adaptive, their tiers absorb cycles starting up to 'slack' seconds
+    early and are kept between runs if 'persist' is set.
+    """
+    nodes = []
+    for hostname, (address, port) in sorted(jcli['nodes'].items()):
+        tiers = None
+        if args.adaptive:
+            path = None
+            if persist:
+                # A single node keeps --tiers-state as is
+                path = args.tiers_state if len(jcli['nodes']) == 1 else '%s.%s' % (args.tiers_state, hostname)
+            tiers = PollScheduler(args.quiet_interval, args.max_interval, slack, path)
+        nodes.append(Node(hostname, address, port, tiers))
+    return nodes
+
+def collect(node):
+    """Run jCli commands through node's pool and return collected metrics,
+    polling only users and smppcs due in node's tiers if set
+
+    A collection reaching the deadline of node's pool is cut short, metrics
+    collected until then are returned and phases count it as 'partial'.
+    """
+    pool = node.pool
+    tiers = node.tiers
+    phases = node.phases
+    host = node.hostname
+    discovery_cache = node.discovery_cache
+    tn = pool.sessions[0]
+    version = pool.version
+    discovery = read_discovery_cache(discovery_cache, args.discovery_ttl)
+
+    def command(c):
+        "Run a single command on first session"
+        with phases.phase('commands'):
+            phases.count('commands')
+            return wait_for_prompt(tn, command = c)
+
+    def listing(c, parse):
+        "Run a single command on first session, its response lines are given to parse() as they arrive"
+        with phases.phase('commands'):
+            phases.count('commands')
+            tn.write(c)
+            return parse(tn.read_lines(command = c))
+
+    def commands(cs):
+        "Run commands across all sessions, the ones left unanswered by the deadline get a None response"
+        with phases.phase('commands'):
+            phases.count('commands', len(cs))
+            responses = pool.run(cs, batch_size = args.batch_size)
+        if None in responses:
+            phases.counters['partial'] = 1
+        return responses
+
+    # Build outcome for requested key
+    metrics = MetricBatch()
+    try:
         for key in keys:
             if key == 'version':
-                metrics.append(Metric(jcli['host'], 'jasmin[%s]' % key, version))
+                metrics.add(host, 'jasmin[%s]' % key, version)
             elif type(key) == dict and 'smppsapi' in key:
-                response = wait_for_prompt(tn, command = "stats --smppsapi\r\n")
-                for k in key['smppsapi']:
-                    metrics.append(Metric(jcli['host'], 'jasmin[smppsapi.%s]' % k, get_stats_value(response, k)))
+                response = command("stats --smppsapi\r\n")
+                with phases.phase('parse'):
+                    stats = parse_stats(response)
+                    for k in key['smppsapi']:
+                        metrics.add(host, 'jasmin[smppsapi.%s]' % k, get_stats_value(stats, k))
             elif type(key) == dict and 'httpapi' in key:
-                response = wait_for_prompt(tn, command = "stats --httpapi\r\n")
-                for k in key['httpapi']:
-                    metrics.append(Metric(jcli['host'], 'jasmin[httpapi.%s]' % k, get_stats_value(response, k)))
+                response = command("stats --httpapi\r\n")
+                with phases.phase('parse'):
+                    stats = parse_stats(response)
+                    for k in key['httpapi']:
+                        metrics.add(host, 'jasmin[httpapi.%s]' % k, get_stats_value(stats, k))
             elif type(key) == dict and 'smppcs' in key:
-                # Get stats from statsm
-                response = wait_for_prompt(tn, command = "stats --smppcs\r\n")
-                smppcs = get_list_ids(response)
-
                 # Get statuses from smppccm
-                response = wait_for_prompt(tn, command = "smppccm -l\r\n")
-                smppcs_status = get_smppcs_service_and_session(response)
+                smppcs_status = listing("smppccm -l\r\n", get_smppcs_service_and_session)
+
+                # Get ids from discovery cache, list them from statsm if cache is outdated
+                # or if smppccm shows connectors were added or removed
+                smppcs = discovery.get('smppcs')
+                polled = smppcs
+                if tiers is not None:
+                    # Listing is the activity check of all connectors, along with their smppccm status
+                    rows = listing("stats --smppcs\r\n", get_list_rows)
+                    smppcs = [cid for cid, row in rows]
+                    write_discovery_cache(discovery_cache, 'smppcs', smppcs)
+                    polled = tiers.due('smppcs', [(cid, '%s %s' % (row, smppcs_status.get(cid))) for cid, row in rows])
+                elif smppcs is None or set(smppcs) != set(smppcs_status):
+                    smppcs = polled = listing("stats --smppcs\r\n", get_list_ids)
+                    write_discovery_cache(discovery_cache, 'smppcs', smppcs)
+                phases.count('polled.smppcs', len(polled))
 
                 # Build outcome
-                for cid in smppcs:
-                    # From stats
-                    response = wait_for_prompt(tn, command = "stats --smppc %s\r\n" % cid)
-                    for k in key['smppcs']:
-                        metrics.append(Metric(jcli['host'], 'jasmin[smppc.%s,%s]' % (k, cid), get_stats_value(response, k)))
-
-                    # From smppccm
-                    metrics.append(Metric(jcli['host'], 'jasmin[smppc.service,%s]' % (cid), smppcs_status[cid]['service']))
-                    metrics.append(Metric(jcli['host'], 'jasmin[smppc.session,%s]' % (cid), smppcs_status[cid]['session']))
+                responses = commands(["stats --smppc %s\r\n" % cid for cid in polled])
+                with phases.phase('parse'):
+                    for cid, response in zip(polled, responses):
+                        if response is None:
+                            continue
+                        # From stats
+                        stats = parse_stats(response)
+                        for k in key['smppcs']:
+                            metrics.add(host, 'jasmin[smppc.%s,%s]' % (k, cid), get_stats_value(stats, k))
+                        if tiers is not None:
+                            tiers.polled('smppcs', cid, [stats.get(k) for k in activity['smppcs']])
+
+                    # From smppccm, for all connectors
+                    for cid in smppcs:
+                        if cid in smppcs_status:
+                            metrics.add(host, 'jasmin[smppc.service,%s]' % (cid), smppcs_status[cid]['service'])
+                            metrics.add(host, 'jasmin[smppc.session,%s]' % (cid), smppcs_status[cid]['session'])
             elif type(key) == dict and 'users' in key:
-                response = wait_for_prompt(tn, command = "stats --users\r\n")
-                users = get_list_ids(response)
-                for uid in users:
-                    response = wait_for_prompt(tn, command = "stats --user %s\r\n" % uid)
-                    for k in key['users']['httpapi']:
-                        metrics.append(Metric(jcli['host'], 'jasmin[user.httpapi.%s,%s]' % (k, uid), get_stats_value(response, k, stat_type = 'HTTP Api')))
-                    for k in key['users']['smppsapi']:
-                        if k in ['bound_rx_count', 'bound_tx_count', 'bound_trx_count']:
-                            r = get_stats_value(response, key = 'bound_connections_count', stat_type = 'SMPP Server')
-                            r = json.loads(r.replace("'", '"'))
-                            if k == 'bound_rx_count':
-                                v = r['bind_receiver']
-                            elif k == 'bound_tx_count':
-                                v = r['bind_transmitter']
-                            elif k == 'bound_trx_count':
-                                v = r['bind_transceiver']
-                        else:
-                            v = get_stats_value(response, k, stat_type = 'SMPP Server')
-                        metrics.append(Metric(jcli['host'], 'jasmin[user.smppsapi.%s,%s]' % (k, uid), v))
-
-        #print metrics
-        # Send packet to zabbix
-        send_to_zabbix(metrics, zabbix_host, zabbix_port)
-    except LockTimeout:
-        print 'Lock not acquired, exiting'
-    except AlreadyLocked:
-        print 'Already locked, exiting'
+                # Listing is the membership check of all users (there is no cheaper one, as
+                # smppccm is for connectors), the discovery cache is refreshed as soon as it
+                # lists an id which is not cached or misses a cached one
+                rows = listing("stats --users\r\n", get_list_rows)
+                users = [uid for uid, row in rows]
+                if discovery.get('users') is None or set(users) != set(discovery['users']):
+                    write_discovery_cache(discovery_cache, 'users', users)
+                if tiers is not None:
+                    # Listing is also the activity check of all users
+                    users = tiers.due('users', rows)
+                phases.count('polled.users', len(users))
+
+                responses = commands(["stats --user %s\r\n" % uid for uid in users])
+                with phases.phase('parse'):
+                    for uid, response in zip(users, responses):
+                        if response is None:
+                            continue
+                        stats = parse_stats(response)
+                        if len(stats) == 0:
+                            # User was removed since listed, next run's listing refreshes the cache
+                            continue
+                        if tiers is not None:
+                            tiers.polled('users', uid, [stats.get(k) for k in activity['users']])
+                        for k in key['users']['httpapi']:
+                            metrics.add(host, 'jasmin[user.httpapi.%s,%s]' % (k, uid), get_stats_value(stats, k, stat_type = 'HTTP Api'))
+                        r = None
+                        for k in key['users']['smppsapi']:
+                            if k in ['bound_rx_count', 'bound_tx_count', 'bound_trx_count']:
+                                if r is None:
+                                    r = get_stats_value(stats, key = 'bound_connections_count', stat_type = 'SMPP Server')
+                                    r = json.loads(r.replace("'", '"'))
+                                if k == 'bound_rx_count':
+                                    v = r['bind_receiver']
+                                elif k == 'bound_tx_count':
+                                    v = r['bind_transmitter']
+                                elif k == 'bound_trx_count':
+                                    v = r['bind_transceiver']
+                            else:
+                                v = get_stats_value(stats, k, stat_type = 'SMPP Server')
+                            metrics.add(host, 'jasmin[user.smppsapi.%s,%s]' % (k, uid), v)
+    except jCliDeadlineError, e:
+        # Out of time, what is left is collected next cycle
+        print 'Node %s cut short: %s' % (host, e)
+        phases.counters['partial'] = 1
+
+    if tiers is not None:
+        tiers.save()
+
+    return metrics
+
+def collector_metrics(node, last_send, runs = None):
+    """Build node's self-monitoring metrics from its current cycle's phases, from
+    'last_send' (ZabbixBatchSender.stats of previous cycle) and from 'runs'
+    (RunGuard.cycle() counts)"""
+    host = node.hostname
+    phases = node.phases
+    metrics = MetricBatch()
+    for phase in ['auth', 'commands', 'parse', 'total']:
+        metrics.add(host, 'jasmin.collector[duration.%s]' % phase,
+            '%.6f' % phases.durations.get(phase, 0))
+    metrics.add(host, 'jasmin.collector[commands]', phases.counters.get('commands', 0))
+    for kind in ['users', 'smppcs']:
+        metrics.add(host, 'jasmin.collector[polled.%s]' % kind, phases.counters.get('polled.%s' % kind, 0))
+    metrics.add(host, 'jasmin.collector[cycles.partial]', phases.counters.get('partial', 0))
+    if runs is not None:
+        for kind in ['coalesced', 'stale']:
+            metrics.add(host, 'jasmin.collector[cycles.%s]' % kind, runs[kind])
+
+    # Previous cycle's send (shared by all nodes) and node's own items in it,
+    # timestamped when it happened
+    if last_send is not None:
+        clock = last_send['clock']
+        metrics.add(host, 'jasmin.collector[duration.serialize]', '%.6f' % last_send['serialize'], clock)
+        metrics.add(host, 'jasmin.collector[duration.send]', '%.6f' % last_send['elapsed'], clock)
+        sent = last_send.get('hosts', {}).get(host, {'items': 0, 'processed': 0})
+        metrics.add(host, 'jasmin.collector[items_sent]', sent['items'], clock)
+        metrics.add(host, 'jasmin.collector[items_failed]', sent['items'] - sent['processed'], clock)
+
+    return metrics
+
+def collect_node(node, deadline):
+    "Return node's collected metrics, opening its pool if needed and giving up by 'deadline'"
+    node.phases.reset()
+    if time.time() >= deadline:
+        # Cycle's budget went to other nodes
+        node.phases.count('partial')
+        return MetricBatch()
+    if node.pool is None:
+        node.pool = jCliPool(args.sessions, node.address, node.port)
+        node.pool.set_deadline(deadline)
+        with node.phases.phase('auth'):
+            node.pool.open()
+    node.pool.set_deadline(deadline)
+    node.pool.reset_timings()
+    with node.phases.phase('total'):
+        return collect(node)
+
+def collect_cycle(nodes, last_send = None, rates = None, runs = None):
+    """Return metrics collected from nodes and their self-monitoring ones (reporting
+    last_send and runs), computing counters rates through rates if set
+
+    Up to --node-concurrency nodes are collected at once, each one for at most
+    --node-timeout seconds: a failed or hung node is reported and does not hold
+    the other nodes' metrics back. Nodes still collecting after --budget seconds
+    are cut short, their metrics are stamped with the cycle's start.
+    """
+    start = time.time()
+    budget = start + args.budget
+    results = fetch([lambda node = node: collect_node(node, min(time.time() + args.node_timeout, budget))
+        for node in nodes], args.node_concurrency)
+
+    metrics = MetricBatch()
+    for node, result in zip(nodes, results):
+        if isinstance(result, Exception):
+            # Session state is unknown: drop it and re-authenticate on next cycle
+            print 'Error on node %s: %s' % (node.hostname, result)
+            node.close()
+            continue
+        if node.phases.counters.get('partial'):
+            # Sessions may still be answering, re-authenticate on next cycle
+            node.close()
+            result.stamp(start)
+        metrics.extend(result)
+    # Once all nodes are done, RateCalculator is not shared between threads
+    if rates is not None:
+        metrics = rates.process(metrics)
+    for node in nodes:
+        metrics.extend(collector_metrics(node, last_send, runs))
+
+    return metrics
+
+def run_cycle(nodes, sender, rates = None, runs = None):
+    """Collect metrics of nodes and send them to Zabbix through sender, computing
+    counters rates through rates if set and reporting runs counts if set"""
+    metrics = collect_cycle(nodes, sender.stats, rates, runs)
+
+    if args.timing:
+        for node in nodes:
+            if node.pool is None:
+                continue
+            for i, (login, count, spent) in enumerate(node.pool.timings):
+                print '%s session %d: login %.3fs, %d commands in %.3fs' % (node.hostname, i, login, count, spent)
+
+    #print metrics
+    # Send packet to zabbix
+    sender.send(metrics)
+
+    if args.timing:
+        if rates is not None and rates.resets:
+            print 'Rates: %d counters reset' % rates.resets
+        if sender.cache is not None:
+            print 'Delta: %d of %d items unchanged' % (sender.cache.suppressed, len(metrics))
+        stats = sender.stats
+        print 'Zabbix: %d/%d batches accepted, %d processed, %d failed of %d items in %.3fs (%d items/s, %.3fs spent by server)' % (
+            stats['batches'] - stats['failed_batches'], stats['batches'], stats['processed'], stats['failed'],
+            stats['total'], stats['elapsed'], stats['processed'] / max(stats['elapsed'], 0.001), stats['seconds_spent'])
+        for node in nodes:
+            print '%s phases: %s' % (node.hostname,
+                ', '.join('%s %.3fs' % (k, v) for k, v in sorted(node.phases.durations.items())))
+
+def daemon(nodes, sender, guard, rates = None):
+    """Collect every 'args.interval' seconds, forever, as guard's holding run
+
+    jCli sessions are kept open between cycles and re-opened only after a failure
+    """
+    # Exit through finally clauses (closing sessions and releasing the lock) when stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    next_run = time.time()
+    while True:
+        try:
+            run_cycle(nodes, sender, rates, guard.cycle())
+        except Exception, e:
+            print type(e)
+            print 'Error: %s' % e
+        guard.done(keep = True)
+        sys.stdout.flush()
+
+        next_run += args.interval
+        delay = next_run - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Cycle overran its interval, do not try to catch up
+            next_run = time.time()
+
+def main():
+    sender = ZabbixBatchSender(zabbix_host, zabbix_port, batch_size = args.zabbix_batch_size,
+        concurrency = args.zabbix_senders,
+        spool = Spool(args.spool_dir, args.spool_size * 1024 * 1024, args.spool_replay) if args.spool_size > 0 else None,
+        cache = LastValueCache(None if args.daemon else args.delta_cache, args.heartbeat) if args.delta else None)
+    rates = None
+    if args.rates != 'none':
+        rates = RateCalculator(is_counter, args.rates, None if args.daemon else args.rates_state)
+    # Cycles starting up to half an interval early still poll what is due
+    nodes = build_nodes(args.interval / 2, persist = not args.daemon)
+    guard = RunGuard(run_guard, args.stale)
+    try:
+        # Runs must not overlap, one started meanwhile is coalesced into this one
+        if not guard.acquire():
+            print 'Previous run still running, coalesced into it'
+            return
+
+        if args.daemon:
+            daemon(nodes, sender, guard, rates)
+        else:
+            # Previous run's send stats
+            try:
+                with open(send_stats_file, 'rb') as f:
+                    sender.stats = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+            # Collect once more for runs coalesced into this one meanwhile
+            while True:
+                run_cycle(nodes, sender, rates, guard.cycle())
+                if not guard.done():
+                    break
+
+            with open(send_stats_file, 'wb') as f:
+                json.dump(sender.stats, f)
     except Exception, e:
         print type(e)
         print 'Error: %s' % e
     finally:
-        if tn is not None and tn.get_socket():
-            tn.close()
-
-        # Release the lock
-        if lock.i_am_locking():
-            lock.release()
+        for node in nodes:
+            node.close()
+        sender.close()
+        guard.release()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,247 @@
+# Shared by jasmin_get.py and jasmin_discover.py: jCli sessions, listings parsing
+# and users and smppcs ids cache
+
+import json, time, re, sys, os, select
+from telnetlib import Telnet, IAC, DO, DONT, WILL, WONT, SB, SE, TTYPE, theNULL
+
+class jCliSessionError(Exception):
+    pass
+
+class jCliDeadlineError(jCliSessionError):
+    pass
+
+class jCliKeyError(Exception):
+    pass
+
+def read_discovery_cache(path, ttl):
+    "Return cached ids lists ('users', 'smppcs') which are not older than 'ttl' seconds"
+    try:
+        with open(path, 'rb') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    now = time.time()
+    # ids are plain ascii (see get_list_ids()), keep them as str for telnet commands
+    return dict((str(kind), [str(i) for i in entry['ids']]) for kind, entry in cache.items()
+        if now - entry['updated'] < ttl)
+
+def write_discovery_cache(path, kind, ids):
+    """Atomically update cached ids list of 'kind' ('users' or 'smppcs'), None to invalidate it
+
+    Failures are reported on stderr, stdout of jasmin_discover.py is Zabbix's LLD JSON
+    """
+    try:
+        try:
+            with open(path, 'rb') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+
+        if ids is None:
+            cache.pop(kind, None)
+        else:
+            cache[kind] = {'ids': ids, 'updated': time.time()}
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            json.dump(cache, f)
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        print >> sys.stderr, 'Cannot write discovery cache %s: %s' % (path, e)
+
+class jCliSession(Telnet):
+    """A jCli telnet session reading responses incrementally
+
+    Telnet.expect() re-matches the prompt over its whole, growing, buffer every
+    time data arrives. read_lines() only scans newly received data for the
+    prompt and hands complete lines over as they arrive: reading is linear in
+    response size and only the line being received is buffered.
+
+    No read waits past 'deadline' (time.time() based) when it is set, see jasmin_get.py's Node.
+    """
+    deadline = None
+
+    def _read_cooked(self, deadline):
+        "Return newly received data (telnet negotiation processed), '' if 'deadline' passed"
+        self.process_rawq()
+        while not self.cookedq:
+            if self.eof:
+                raise EOFError('telnet connection closed')
+            timeout = deadline - time.time()
+            if timeout <= 0 or not select.select([self.fileno()], [], [], timeout)[0]:
+                return ''
+            # Telnet.fill_rawq() reads 50 bytes at once and process_rawq() cooks them
+            # byte per byte, only do so for data holding telnet commands
+            buf = self.sock.recv(65536)
+            self.eof = not buf
+            if self.rawq or self.iacseq or self.sb or IAC in buf:
+                self.rawq = self.rawq[self.irawq:] + buf
+                self.irawq = 0
+                self.process_rawq()
+            else:
+                self.cookedq += buf.replace(theNULL, '').replace('\021', '')
+        data = self.cookedq
+        self.cookedq = ''
+        return data
+
+    def read_lines(self, prompt = 'jcli :', to = 20, command = None):
+        """Yield response lines as they arrive, until 'prompt'
+
+        Will raise an exception if 'prompt' is not obtained after 'to' seconds,
+        a jCliDeadlineError if not by session's deadline, 'command' is the one
+        named in this exception
+        """
+        deadline = time.time() + to
+        expiring = self.deadline is not None and self.deadline < deadline
+        if expiring:
+            deadline = self.deadline
+        # Data following the previous prompt
+        buf = self.cookedq
+        self.cookedq = ''
+        start = 0
+        while True:
+            i = buf.find(prompt, start)
+            if i >= 0:
+                # Whatever follows is next response's
+                self.cookedq = buf[i + len(prompt):] + self.cookedq
+                for line in buf[:i].splitlines():
+                    yield line
+                return
+
+            # Hand complete lines over, the partial one may hold the beginning of prompt
+            j = buf.rfind('\n')
+            if j >= 0:
+                for line in buf[:j].splitlines():
+                    yield line
+                buf = buf[j + 1:]
+            start = max(0, len(buf) - len(prompt) + 1)
+
+            data = self._read_cooked(deadline)
+            if not data:
+                if expiring:
+                    raise jCliDeadlineError('Deadline reached waiting for prompt (%s) for command (%s)' % (prompt, command))
+                if command is None:
+                    raise jCliSessionError('Did not get prompt (%s)' % prompt)
+                raise jCliSessionError('Did not get prompt (%s) for command (%s)' % (prompt, command))
+            buf += data
+
+def process_option(tn, command, option):
+    if command == DO and option == TTYPE:
+        tn.sendall(IAC + WILL + TTYPE)
+        #print 'Sending terminal type "mypython"'
+        tn.sendall(IAC + SB + TTYPE + '\0' + 'mypython' + IAC + SE)
+    elif command in (DO, DONT):
+        #print 'Will', ord(option)
+        tn.sendall(IAC + WILL + option)
+    elif command in (WILL, WONT):
+        #print 'Do', ord(option)
+        tn.sendall(IAC + DO + option)
+
+def wait_for_prompt(tn, command = None, prompt = r'jcli :', to = 20):
+    """Will send 'command' (if set) and wait for prompt
+
+    Will raise an exception if 'prompt' is not obtained after 'to' seconds
+    """
+
+    if command is not None:
+        tn.write(command)
+
+    return '\n'.join(tn.read_lines(prompt, to, command))
+
+def wait_for_prompts(tn, commands, prompt = r'jcli :', to = 20, batch_size = 50, responses = None):
+    """Will send 'commands' by batches of 'batch_size' and wait for one prompt per command
+
+    Every batch is written at once, the returned stream is then split on prompt
+    boundaries: responses are returned in the same order as 'commands'.
+    Will raise an exception if any prompt is not obtained after 'to' seconds,
+    responses obtained until then are left in 'responses' if given
+    """
+
+    if responses is None:
+        responses = []
+    batch_size = max(1, batch_size)
+    for i in range(0, len(commands), batch_size):
+        batch = commands[i:i + batch_size]
+        tn.write(''.join(batch))
+        for command in batch:
+            responses.append('\n'.join(tn.read_lines(prompt, to, command)))
+
+    return responses
+
+def response_lines(response):
+    "Lines of a response, given as a string or as lines (e.g. from jCliSession.read_lines())"
+    if isinstance(response, basestring):
+        return response.splitlines()
+    return response
+
+# Precompiled pattern for listings: item's id and the rest of its row
+list_line_re = re.compile(r"#([A-Za-z0-9_-]+)(?:\s+(.*)|$)")
+
+def get_list_ids(response):
+    """Parse response and get list IDs, otherwise raise a jCliKeyError
+
+    Response may be given as lines, they are parsed as they come.
+    """
+    return [o for o, row in get_list_rows(response)]
+
+def get_list_rows(response):
+    """Parse response and get (ID, rest of its row) of every listed item, otherwise raise a jCliKeyError
+
+    Response may be given as lines, they are parsed as they come.
+    """
+    rows = []
+    matched = False
+    first = None
+    for line in response_lines(response):
+        if first is None:
+            first = line
+        m = list_line_re.match(line)
+        if m is None:
+            continue
+        matched = True
+        if m.group(1) not in ['Connector', 'User']:
+            rows.append((m.group(1), (m.group(2) or '').rstrip()))
+    if not matched:
+        raise jCliKeyError('Cannot extract ids from response %s' % first)
+
+    return rows
+
+def jcli_connect(address, port, username, password, deadline = None):
+    """Connect and authenticate to jCli at address:port, giving up by 'deadline' if set
+
+    Will return the telnet session (waiting at prompt) and Jasmin's version
+    """
+
+    def to():
+        "Login steps timeout, not going past deadline"
+        if deadline is None:
+            return 16
+        return max(0, min(16, deadline - time.time()))
+
+    tn = jCliSession(address, port, to() or 0.001)
+    tn.deadline = deadline
+
+    # for telnet session debug:
+    #tn.set_debuglevel(1000)
+
+    tn.set_option_negotiation_callback(process_option)
+
+    tn.read_until('Authentication required', to())
+    tn.write("\r\n")
+    tn.read_until("Username:", to())
+    tn.write(username+"\r\n")
+    tn.read_until("Password:", to())
+    tn.write(password+"\r\n")
+
+    # We must be connected
+    idx, obj, response = tn.expect([r'Welcome to Jasmin ([0-9a-z\.]+) console'], to())
+    if idx == -1:
+        tn.close()
+        raise jCliSessionError('Authentication failure')
+    version = obj.group(1)
+
+    # Wait for prompt
+    wait_for_prompt(tn)
+
+    return tn, version
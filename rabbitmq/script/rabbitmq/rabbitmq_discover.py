@@ -1,57 +1,90 @@
 #!/usr/bin/python
 # This a script is called by Zabbix agent to discover rabbitmq queues
 
-import json, struct, time, argparse, re, socket, sys
+import json, struct, time, argparse, re, socket, sys, os
 from lockfile import FileLock, LockTimeout, AlreadyLocked
-from pyrabbit.api import Client as RabbitClient
+
+# Shared modules: this script's own and script/common/ ones
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [script_dir, os.path.join(os.path.dirname(script_dir), 'common')]
+from zabbix_common import fetch
+from rabbitmq_management import ManagementClient, QueueSelector
 
 # The script must not be executed simultaneously
 lock = FileLock("/tmp/rabbiqmq_discover")
 
 parser = argparse.ArgumentParser(description='Zabbix RabbitMQ LLD script')
 parser.add_argument('--hostname', required=True, help = "RabbitMQ's hostname (same configured in Zabbix hosts)")
-parser.add_argument('-d', required=True, help = "queues")
+parser.add_argument('-d', required=True, help = "queues or vhosts")
+parser.add_argument('--page-size', type=int, default=500, help = "Number of queues fetched per management API request")
+parser.add_argument('--vhosts', nargs='+', help = "RabbitMQ vhosts to cover (default: '/')")
+parser.add_argument('--http-concurrency', type=int, default=4, help = "Number of concurrent management API requests")
+parser.add_argument('--top', type=int, default=0,
+    help = "Number of biggest queues (by each of --top-by) getting per-queue items in every vhost, 0 for all queues")
+parser.add_argument('--top-by', nargs='+', default=['messages', 'memory'], choices=['messages', 'memory'],
+    help = "Queue columns ranking queues for --top")
+parser.add_argument('--min-messages', type=int, help = "Queues with at least this many messages always get per-queue items")
+parser.add_argument('--min-memory', type=int, help = "Queues using at least this many bytes always get per-queue items")
+parser.add_argument('--hold', type=int, default=3600,
+    help = "Seconds a queue keeps its per-queue items after it stopped being selected")
 args = parser.parse_args()
+thresholds = {}
+if args.min_messages is not None:
+    thresholds['messages'] = args.min_messages
+if args.min_memory is not None:
+    thresholds['memory'] = args.min_memory
 
 # Configuration
 rabbitmq = {'host': args.hostname, # Must be the same configured in Zabbix hosts !
             'port': 15672,
             'username': 'guest',
             'password': 'guest',
-            'vhost': '/'}
+            'vhost': '/'} # Default vhost, its items are static in the template
+# Queues getting per-queue items, shared between rabbitmq_get.py and rabbitmq_discover.py
+queues_selection = '/tmp/rabbitmq_queues_%s.json' % rabbitmq['host']
 
 # Discovery keys
 keys = []
 keys.append('queues')
-
-class NullWriter(object):
-    def write(self, arg):
-        pass
+keys.append('vhosts')
 
 def main():
-    rabbit = None
+    client = ManagementClient(rabbitmq['host'], rabbitmq['port'], rabbitmq['username'], rabbitmq['password'])
+    selector = QueueSelector(queues_selection, args.top, args.top_by, thresholds, args.hold)
     outcome = None
     try:
         # Ensure there are no paralell runs of this script
         lock.acquire(timeout=5)
 
-        # Connect to Rabbit
-        nullwrite = NullWriter()
-        oldstdout = sys.stdout
-        sys.stdout = nullwrite # disable output
-        rabbit = RabbitClient('%s:%s' % (rabbitmq['host'], rabbitmq['port']),
-            rabbitmq['username'],
-            rabbitmq['password'])
-        if not rabbit.is_alive():
+        # Alive check and queues listing are independent requests, issue them all at once
+        vhosts = args.vhosts or [rabbitmq['vhost']]
+        calls = [lambda: client.is_alive(vhosts[0])]
+        if args.d == 'queues':
+            for vhost in vhosts:
+                calls.append(lambda vhost = vhost: list(client.iter_queues(vhost, ['name'] + selector.columns(), args.page_size)))
+        results = fetch(calls, args.http_concurrency)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        if not results[0]:
             raise Exception('Cannot connect to RabbitMQ')
-        queues = rabbit.get_queues(rabbitmq['vhost'])
-        sys.stdout = oldstdout # enable output
+        # Only discover queues getting per-queue items from rabbitmq_get.py, which
+        # owns the selection file: it is read here but never written
+        results[1:] = [sorted(selector.select(vhost, queues)) for vhost, queues in zip(vhosts, results[1:])]
 
         # Build outcome
         if args.d == 'queues':
             outcome = {'data': []}
-            for queue in queues:
-                outcome['data'].append({'{#QUEUE}': queue['name']})
+            for vhost, queues in zip(vhosts, results[1:]):
+                for queue in queues:
+                    # Item keys are [{#QUEUENAME},{#VHOST}], {#QUEUE} is only displayed
+                    if vhost == rabbitmq['vhost']:
+                        outcome['data'].append({'{#QUEUE}': queue, '{#QUEUENAME}': queue, '{#VHOST}': vhost})
+                    else:
+                        outcome['data'].append({'{#QUEUE}': '%s (%s)' % (queue, vhost), '{#QUEUENAME}': queue, '{#VHOST}': vhost})
+        elif args.d == 'vhosts':
+            # Items of the default vhost are static in the template
+            outcome = {'data': [{'{#VHOST}': vhost} for vhost in vhosts if vhost != rabbitmq['vhost']]}
     except LockTimeout:
         print 'Lock not acquired, exiting'
     except AlreadyLocked:
@@ -60,6 +93,7 @@ def main():
         print type(e)
         print 'Error: %s' % e
     finally:
+        client.close()
         if outcome is not None:
             print json.dumps(outcome)
 
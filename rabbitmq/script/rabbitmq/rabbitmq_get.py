@@ -3,16 +3,48 @@
 # All metrics are gathered using Active agent.
 # Metrics are covering Jasmin and its connectors queue status
 
-import json, struct, time, argparse, re, socket, sys
-from lockfile import FileLock, LockTimeout, AlreadyLocked
-from pyrabbit.api import Client as RabbitClient
+import json, struct, time, argparse, re, socket, sys, urllib, os
 
-# The script must not be executed simultaneously
-lock = FileLock("/tmp/rabbitmq_get")
+# Shared modules: this script's own and script/common/ ones
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [script_dir, os.path.join(os.path.dirname(script_dir), 'common')]
+from zabbix_common import MetricBatch, ZabbixBatchSender, Spool, LastValueCache, RateCalculator, RunGuard, fetch
+from rabbitmq_management import ManagementClient, QueueSelector
 
 parser = argparse.ArgumentParser(description='Zabbix RabbitMQ status script')
 parser.add_argument('--hostname', required=True, help = "RabbitMQ's hostname (same configured in Zabbix hosts)")
+parser.add_argument('--zabbix-batch-size', type=int, default=250, help = "Maximum number of items per trapper packet")
+parser.add_argument('--zabbix-senders', type=int, default=1, help = "Number of concurrent connections to Zabbix trapper")
+parser.add_argument('--spool-dir', default='/tmp/rabbitmq_get.spool', help = "Where metrics failing to reach Zabbix are kept for replay")
+parser.add_argument('--spool-size', type=int, default=64, help = "Maximum spool size in MB (0 to disable spooling)")
+parser.add_argument('--spool-replay', type=int, default=10000, help = "Maximum number of spooled metrics replayed per cycle")
+parser.add_argument('--delta', action='store_true', help = "Send changed values only (and all values every --heartbeat seconds)")
+parser.add_argument('--heartbeat', type=int, default=600, help = "Maximum age of a value in Zabbix in delta mode (seconds)")
+parser.add_argument('--delta-cache', default='/tmp/rabbitmq_get.cache', help = "Where last sent values are kept between runs in delta mode")
+parser.add_argument('--page-size', type=int, default=500, help = "Number of queues fetched per management API request")
+parser.add_argument('--vhosts', nargs='+', help = "RabbitMQ vhosts to cover (default: '/')")
+parser.add_argument('--http-concurrency', type=int, default=4, help = "Number of concurrent management API requests")
+parser.add_argument('--top', type=int, default=0,
+    help = "Number of biggest queues (by each of --top-by) getting per-queue items in every vhost, 0 for all queues")
+parser.add_argument('--top-by', nargs='+', default=['messages', 'memory'], choices=['messages', 'memory'],
+    help = "Queue columns ranking queues for --top")
+parser.add_argument('--min-messages', type=int, help = "Queues with at least this many messages always get per-queue items")
+parser.add_argument('--min-memory', type=int, help = "Queues using at least this many bytes always get per-queue items")
+parser.add_argument('--hold', type=int, default=3600,
+    help = "Seconds a queue keeps its per-queue items after it stopped being selected")
+parser.add_argument('--rates', choices=['none', 'replace', 'both'], default='none',
+    help = "Send counters as per-second rates (replace) or rates along with counters (both)")
+parser.add_argument('--rates-state', default='/tmp/rabbitmq_get.rates', help = "Where last counter samples are kept between runs")
+parser.add_argument('--budget', type=float, default=50,
+    help = "Maximum duration of a collection (seconds), it is then cut short and what was collected is sent")
+parser.add_argument('--stale', type=int, default=300,
+    help = "Age of a running collection after which it is deemed hung and terminated by the next run (seconds)")
 args = parser.parse_args()
+thresholds = {}
+if args.min_messages is not None:
+    thresholds['messages'] = args.min_messages
+if args.min_memory is not None:
+    thresholds['memory'] = args.min_memory
 
 # Configuration
 zabbix_host = 'monitoring.jookies.net'  # Zabbix Server IP
@@ -21,7 +53,11 @@ rabbitmq = {'host': args.hostname, # Must be the same configured in Zabbix hosts
             'port': 15672,
             'username': 'guest',
             'password': 'guest',
-            'vhost': '/'}
+            'vhost': '/'} # Default vhost, its metrics keys have no vhost parameter
+# Queues getting per-queue items, shared between rabbitmq_get.py and rabbitmq_discover.py
+queues_selection = '/tmp/rabbitmq_queues_%s.json' % rabbitmq['host']
+# Runs exclusion (the script must not be executed simultaneously), see RunGuard
+run_guard = '/tmp/rabbitmq_get.run'
 
 # Monitoring keys
 keys = []
@@ -46,73 +82,15 @@ keys.append({'queues': [
     'memory',
     'consumers',
 ]})
+# Keys of cumulative counters, queues and messages keys are gauges
+counters = ['rabbitmq.vhost.recv_oct', 'rabbitmq.vhost.send_oct']
+for key in keys:
+    if type(key) == dict and 'vhost.message_stats' in key:
+        counters.extend('rabbitmq.vhost.message_stats.%s' % subkey for subkey in key['vhost.message_stats'])
 
-class Metric(object):
-    def __init__(self, host, key, value, clock=None):
-        self.host = host
-        self.key = key
-        self.value = value
-        self.clock = clock
-
-    def __repr__(self):
-        result = None
-        if self.clock is None:
-            result = 'Metric(%r, %r, %r)' % (self.host, self.key, self.value)
-        else:
-            result = 'Metric(%r, %r, %r, %r)' % (self.host, self.key, self.value, self.clock)
-        return result
-
-def send_to_zabbix(metrics, zabbix_host='127.0.0.1', zabbix_port=10051):
-    result = None
-    j = json.dumps
-    metrics_data = []
-    for m in metrics:
-        clock = m.clock or ('%d' % time.time())
-        metrics_data.append(('{"host":%s,"key":%s,"value":%s,"clock":%s}') % (j(m.host), j(m.key), j(m.value), j(clock)))
-    json_data = ('{"request":"sender data","data":[%s]}') % (','.join(metrics_data))
-    data_len = struct.pack('<Q', len(json_data))
-    packet = 'ZBXD\x01'+ data_len + json_data
-
-    # For debug:
-    #print(packet)
-    #print(':'.join(x.encode('hex') for x in packet))
-
-    try:
-        zabbix = socket.socket()
-        zabbix.settimeout(120)
-        zabbix.connect((zabbix_host, zabbix_port))
-        zabbix.sendall(packet)
-        resp_hdr = _recv_all(zabbix, 13)
-        if not resp_hdr.startswith('ZBXD\x01') or len(resp_hdr) != 13:
-            print('Wrong zabbix response')
-            result = False
-        else:
-            resp_body_len = struct.unpack('<Q', resp_hdr[5:])[0]
-            resp_body = zabbix.recv(resp_body_len)
-            zabbix.close()
-
-            resp = json.loads(resp_body)
-            # For debug
-            # print(resp)
-            if resp.get('response') == 'success':
-                result = True
-            else:
-                print('Got error from Zabbix: %s' % resp)
-                result = False
-    except Exception, e:
-        print('Error while sending data to Zabbix: %s' % e)
-        result = False
-    finally:
-        return result
-
-def _recv_all(sock, count):
-    buf = ''
-    while len(buf)<count:
-        chunk = sock.recv(count-len(buf))
-        if not chunk:
-            return buf
-        buf += chunk
-    return buf
+def is_counter(key):
+    "Tell whether key (e.g. rabbitmq.vhost.message_stats.ack[vhost]) is a cumulative counter"
+    return key.split('[')[0] in counters
 
 def process_option(tsocket, command, option):
     if command == DO and option == TTYPE:
@@ -126,61 +104,144 @@ def process_option(tsocket, command, option):
         #print 'Do not', ord(option)
         tsocket.sendall(IAC + DONT + option)
 
-class NullWriter(object):
-    def write(self, arg):
-        pass
+def quote_param(param):
+    "Quote item key parameter the way Zabbix does when substituting LLD macros"
+    if param.startswith('"') or param.startswith(' ') or ',' in param or ']' in param:
+        return '"%s"' % param.replace('"', '\\"')
+    return param
+
+def item_key(key, vhost, params = []):
+    """Build item key, vhost is added as last parameter unless it is the default
+    one and there are no other parameters (queue keys always carry the vhost, as
+    discovered by rabbitmq_discover.py)"""
+    if vhost != rabbitmq['vhost'] or len(params) > 0:
+        params = params + [vhost]
+    if len(params) == 0:
+        return key
+    return '%s[%s]' % (key, ','.join(quote_param(param) for param in params))
+
+def collect_vhost(client, vhost):
+    "Return vhost's metrics"
+    data = client.get('/api/vhosts/%s' % urllib.quote(vhost, ''))
+    metrics = MetricBatch()
+    for key in keys:
+        if type(key) == dict and 'vhost' in key:
+            for subkey in key['vhost']:
+                if subkey in data:
+                    metrics.add(rabbitmq['host'], item_key('rabbitmq.%s.%s' % ('vhost', subkey), vhost), data[subkey])
+        elif type(key) == dict and 'vhost.message_stats' in key:
+            for subkey in key['vhost.message_stats']:
+                if subkey in data.get('message_stats', {}):
+                    metrics.add(rabbitmq['host'], item_key('rabbitmq.%s.%s' % ('vhost.message_stats', subkey), vhost),
+                        data['message_stats'][subkey])
+
+    return metrics
+
+def collect_queues(client, vhost, selector):
+    """Return metrics of vhost's queues selected by selector, other queues are
+    rolled up into rabbitmq.queues.other.* metrics"""
+    metrics = MetricBatch()
+    for key in keys:
+        if type(key) == dict and 'queues' in key:
+            queues = list(client.iter_queues(vhost, list(set(['name'] + key['queues'] + selector.columns())), args.page_size))
+            selected = selector.select(vhost, queues)
+            if selector.enabled():
+                others = [q for q in queues if q['name'] not in selected]
+                metrics.add(rabbitmq['host'], item_key('rabbitmq.queues.other.count', vhost), len(others))
+                for subkey in key['queues']:
+                    metrics.add(rabbitmq['host'], item_key('rabbitmq.queues.other.%s' % subkey, vhost),
+                        sum(q.get(subkey, 0) for q in others))
+
+            for queue in queues:
+                if queue['name'] not in selected:
+                    continue
+                for subkey in key['queues']:
+                    if subkey in queue:
+                        metrics.add(rabbitmq['host'], item_key('rabbitmq.%s.%s' % ('queue', subkey), vhost, [queue['name']]),
+                            queue[subkey])
+
+    return metrics
+
+def collector_metrics(partial, runs = None):
+    """Build self-monitoring metrics of a collection, cut short if 'partial', and
+    of 'runs' (RunGuard.cycle() counts)"""
+    metrics = MetricBatch()
+    metrics.add(rabbitmq['host'], 'rabbitmq.collector[cycles.partial]', 1 if partial else 0)
+    if runs is not None:
+        for kind in ['coalesced', 'stale']:
+            metrics.add(rabbitmq['host'], 'rabbitmq.collector[cycles.%s]' % kind, runs[kind])
+
+    return metrics
+
+def collect(client, selector, rates = None, runs = None):
+    """Return metrics of every vhost and their queues and self-monitoring ones
+    (reporting runs if set), computing counters rates through rates if set
+
+    Requests still running after --budget seconds are left behind, the metrics
+    collected until then are stamped with the collection start. A failing vhost
+    (e.g. a missing one) is reported and does not hide the others.
+    """
+    start = time.time()
+    # Alive check, vhosts and queues are independent requests, issue them all at once
+    vhosts = args.vhosts or [rabbitmq['vhost']]
+    calls = [lambda: client.is_alive(vhosts[0])]
+    for vhost in vhosts:
+        calls.append(lambda vhost = vhost: collect_vhost(client, vhost))
+        calls.append(lambda vhost = vhost: collect_queues(client, vhost, selector))
+    results = fetch(calls, args.http_concurrency, start + args.budget)
+    if isinstance(results[0], Exception):
+        raise results[0]
+    if results[0] is False:
+        raise Exception('Cannot connect to RabbitMQ')
+    selector.save()
+
+    # Build outcome, a failing vhost must not hide the others
+    metrics = MetricBatch()
+    for i, result in enumerate(results[1:]):
+        if isinstance(result, Exception):
+            print 'Error on vhost %s: %s' % (vhosts[i / 2], result)
+        elif result is not None:
+            metrics.extend(result)
+    partial = None in results
+    if partial:
+        print 'Collection cut short after %ss' % args.budget
+        metrics.stamp(start)
+    if rates is not None:
+        metrics = rates.process(metrics)
+    metrics.extend(collector_metrics(partial, runs))
+
+    return metrics
 
 def main():
-    rabbit = None
+    client = ManagementClient(rabbitmq['host'], rabbitmq['port'], rabbitmq['username'], rabbitmq['password'])
+    sender = ZabbixBatchSender(zabbix_host, zabbix_port, batch_size = args.zabbix_batch_size,
+        concurrency = args.zabbix_senders,
+        spool = Spool(args.spool_dir, args.spool_size * 1024 * 1024, args.spool_replay) if args.spool_size > 0 else None,
+        cache = LastValueCache(args.delta_cache, args.heartbeat) if args.delta else None)
+    selector = QueueSelector(queues_selection, args.top, args.top_by, thresholds, args.hold)
+    rates = RateCalculator(is_counter, args.rates, args.rates_state) if args.rates != 'none' else None
+    guard = RunGuard(run_guard, args.stale)
     try:
-        # Ensure there are no paralell runs of this script
-        lock.acquire(timeout=5)
-
-        # Connect to Rabbit
-        nullwrite = NullWriter()
-        oldstdout = sys.stdout
-        sys.stdout = nullwrite # disable output
-        rabbit = RabbitClient('%s:%s' % (rabbitmq['host'], rabbitmq['port']), 
-            rabbitmq['username'], 
-            rabbitmq['password'])
-        if not rabbit.is_alive():
-            raise Exception('Cannot connect to RabbitMQ')
-        vhost = rabbit.get_vhost(rabbitmq['vhost'])
-        queues = rabbit.get_queues(rabbitmq['vhost'])
-        sys.stdout = oldstdout # enable output
-
-        # Build outcome
-        metrics = []
-        for key in keys:
-            if type(key) == dict and 'vhost' in key:
-                for subkey in key['vhost']:
-                    if subkey in vhost:
-                        metrics.append(Metric(rabbitmq['host'], 'rabbitmq.%s.%s' % ('vhost', subkey), vhost[subkey]))
-            elif type(key) == dict and 'vhost.message_stats' in key:
-                for subkey in key['vhost.message_stats']:
-                    if subkey in vhost['message_stats']:
-                        metrics.append(Metric(rabbitmq['host'], 'rabbitmq.%s.%s' % ('vhost.message_stats', subkey), 
-                            vhost['message_stats'][subkey]))
-            elif type(key) == dict and 'queues' in key:
-                for queue in queues:
-                    for subkey in key['queues']:
-                        if subkey in queue:
-                            metrics.append(Metric(rabbitmq['host'], 'rabbitmq.%s.%s[%s]' % ('queue', subkey, queue['name']), 
-                                queue[subkey]))
-
-        # Send packet to zabbix
-        send_to_zabbix(metrics, zabbix_host, zabbix_port)
-    except LockTimeout:
-        print 'Lock not acquired, exiting'
-    except AlreadyLocked:
-        print 'Already locked, exiting'
+        # Runs must not overlap, one started meanwhile is coalesced into this one
+        if not guard.acquire():
+            print 'Previous run still running, coalesced into it'
+            return
+
+        # Collect once more for runs coalesced into this one meanwhile
+        while True:
+            metrics = collect(client, selector, rates, guard.cycle())
+
+            # Send packet to zabbix
+            sender.send(metrics)
+            if not guard.done():
+                break
     except Exception, e:
         print type(e)
         print 'Error: %s' % e
     finally:
-        # Release the lock
-        if lock.i_am_locking():
-            lock.release()
+        client.close()
+        sender.close()
+        guard.release()
 
 if __name__ == '__main__':
     main()
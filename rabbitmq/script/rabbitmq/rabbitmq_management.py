@@ -0,0 +1,147 @@
+# Shared by rabbitmq_get.py and rabbitmq_discover.py: management API client and
+# queues selection
+
+import json, time, socket, httplib, urllib, base64, Queue, threading, os, sys
+
+class QueueSelector(object):
+    """Select the queues getting per-queue items, to bound the number of items
+
+    In every vhost, the 'top' biggest queues by each of 'by' columns are selected
+    along with any queue reaching one of 'thresholds' ({column: minimum}). A queue
+    stays selected for 'hold' seconds after it stopped matching, so it does not
+    churn in and out of discovery. Selection times are persisted to 'path' by
+    rabbitmq_get.py with save(), rabbitmq_discover.py only reads them.
+    Every queue is selected when there is neither 'top' nor 'thresholds'.
+    """
+
+    def __init__(self, path, top = 0, by = ['messages', 'memory'], thresholds = {}, hold = 3600):
+        self.path = path
+        self.top = top
+        self.by = by
+        self.thresholds = thresholds
+        self.hold = hold
+        self.lock = threading.Lock()
+        self.selected = {}
+        if self.enabled() and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.selected = json.load(f)
+            except (IOError, ValueError), e:
+                # Not on stdout, rabbitmq_discover.py prints LLD JSON there
+                print >> sys.stderr, 'Ignoring queues selection %s: %s' % (path, e)
+
+    def enabled(self):
+        return self.top > 0 or len(self.thresholds) > 0
+
+    def columns(self):
+        "Queue columns needed by select()"
+        return list(set(self.by) | set(self.thresholds.keys()))
+
+    def select(self, vhost, queues):
+        "Return the set of selected names among vhost's queues (dicts with name and columns())"
+        if not self.enabled():
+            return set(q['name'] for q in queues)
+
+        matching = set()
+        if self.top > 0:
+            for column in self.by:
+                ranked = sorted(queues, key = lambda q: q.get(column, 0), reverse = True)
+                matching.update(q['name'] for q in ranked[:self.top])
+        for column, minimum in self.thresholds.items():
+            matching.update(q['name'] for q in queues if q.get(column, 0) >= minimum)
+
+        now = time.time()
+        with self.lock:
+            # Forget deleted queues and queues not matching since 'hold' seconds
+            last = self.selected.get(vhost, {})
+            selected = dict((q['name'], last[q['name']]) for q in queues
+                if q['name'] in last and now - last[q['name']] < self.hold)
+            for name in matching:
+                selected[name] = now
+            self.selected[vhost] = selected
+
+        return set(selected.keys())
+
+    def save(self):
+        if not self.enabled():
+            return
+        with self.lock:
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump(self.selected, f)
+            os.rename(self.path + '.tmp', self.path)
+
+class ManagementClient(object):
+    """A small RabbitMQ management API client
+
+    Connections are kept alive and reused across requests, independent requests
+    can be issued from concurrent threads (see zabbix_common.fetch()), each one
+    over its own connection.
+    """
+
+    def __init__(self, host, port, username, password, timeout = 30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.headers = {'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (username, password))}
+        # Idle connections, ready to be reused
+        self.idle = Queue.Queue()
+
+    def get(self, path, **params):
+        "GET path and return the decoded JSON body"
+        url = path
+        if len(params) > 0:
+            url += '?' + urllib.urlencode(params)
+
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+
+        for attempt in range(2):
+            try:
+                conn.request('GET', url, headers = self.headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # Server may have closed the kept-alive connection, retry once on a new one
+                conn.close()
+                if attempt == 1:
+                    raise
+        self.idle.put(conn)
+
+        if resp.status != 200:
+            raise Exception('Cannot get %s (HTTP %s): %s' % (path, resp.status, body))
+        return json.loads(body)
+
+    def iter_queues(self, vhost, columns, page_size = 500):
+        """Iterate over vhost's queues
+
+        Only 'columns' are requested and queues are fetched page by page, so memory
+        and transfer are bound to one page of the requested columns.
+        """
+        page = 1
+        while True:
+            data = self.get('/api/queues/%s' % urllib.quote(vhost, ''), columns = ','.join(columns),
+                page = page, page_size = page_size)
+            if type(data) == list:
+                # Pagination is not supported (RabbitMQ < 3.6), got all queues at once
+                for queue in data:
+                    yield queue
+                return
+
+            for queue in data['items']:
+                yield queue
+            if page >= data['page_count']:
+                return
+            page += 1
+
+    def is_alive(self, vhost):
+        return self.get('/api/aliveness-test/%s' % urllib.quote(vhost, '')).get('status') == 'ok'
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
@@ -1,17 +1,65 @@
-import sys
+#!/usr/bin/python
+# This a script is called by Zabbix agent to discover redis instances and dbs
+# Instances and their dbs are read from redis_get.py's discovery cache, or from
+# an INFO dump given with --info, key families from its keyspace analysis state
 
-dbs = str.split(sys.stdin.readlines()[0])
+import json, argparse, sys
+from redis_common import discovery_cache_path, analysis_state_path, parse_keyspace, db_name
 
-# Open json data
-r = '{"data":['
+parser = argparse.ArgumentParser(description='Zabbix Redis LLD script')
+parser.add_argument('--hostname', required=True, help = "Redis' hostname (same configured in Zabbix hosts)")
+parser.add_argument('-d', default='databases', choices=['databases', 'instances', 'families'],
+    help = "databases, instances or families")
+parser.add_argument('--info', metavar='PATH',
+    help = "Discover the default instance's dbs from this INFO (or INFO keyspace) dump instead, - for stdin")
+args = parser.parse_args()
 
-counter = 0
-for db in dbs:
-    if counter > 0:
-        r+= ','
-    r+= '{"{#DBNAME}":"%s"}' % db
+# Configuration
+discovery_cache = discovery_cache_path(args.hostname)
+analysis_state = analysis_state_path(args.hostname)
+# Keyspace attributes given as macros, e.g. {#KEYS}
+attributes = ['keys', 'expires', 'avg_ttl']
 
-# Close json data
-r+= ']}'
+def load(path):
+    try:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-print r
+outcome = {'data': []}
+if args.d == 'families':
+    instances = load(analysis_state).get('instances', {})
+    for instance in sorted(instances):
+        for db in sorted(instances[instance]):
+            for family in instances[instance][db]['families']:
+                outcome['data'].append({'{#DBNAME}': db_name(db, instance), '{#DB}': db, '{#INSTANCE}': instance,
+                    '{#FAMILY}': family})
+else:
+    if args.info == '-':
+        instances = {'default': parse_keyspace(sys.stdin)}
+    elif args.info is not None:
+        with open(args.info, 'rb') as f:
+            instances = {'default': parse_keyspace(f)}
+    else:
+        instances = load(discovery_cache)
+
+    for instance in sorted(instances):
+        if args.d == 'instances':
+            # The default instance is covered by the template's items
+            if instance != 'default':
+                outcome['data'].append({'{#INSTANCE}': instance})
+        else:
+            keyspace = instances[instance]
+            if type(keyspace) == list:
+                # Cache written before keyspace attributes were recorded
+                keyspace = dict((db, {}) for db in keyspace)
+            for db in sorted(keyspace, key = lambda db: int(db[2:])):
+                # {#DBNAME} is the redis.keyspace key parameter
+                entry = {'{#DBNAME}': db_name(db, instance), '{#DB}': db, '{#INSTANCE}': instance}
+                for attr in attributes:
+                    if attr in keyspace[db]:
+                        entry['{#%s}' % attr.upper()] = keyspace[db][attr]
+                outcome['data'].append(entry)
+
+print json.dumps(outcome)
@@ -0,0 +1,48 @@
+# Shared by redis_get.py and redis-db-discoverer.py: INFO parsing, db names in
+# keys and where the discovery cache and analysis state are kept
+
+def discovery_cache_path(host):
+    "Instances and their dbs keyspace attributes, written by redis_get.py"
+    return '/tmp/redis_discovery_%s.json' % host
+
+def analysis_state_path(host):
+    "Keyspace analysis cursors and found families, written by redis_get.py"
+    return '/tmp/redis_analysis_%s.json' % host
+
+def parse_db(value):
+    "Parse the value of a 'dbN:keys=..,expires=..' keyspace line into {attribute: value}"
+    return dict(attr.split('=', 1) for attr in value.split(',') if '=' in attr)
+
+def parse_info(response):
+    """Parse INFO response into a dict of field: value, every 'dbN' line of the
+    Keyspace section being parsed into a dict of its attributes"""
+    info = {}
+    section = None
+    for line in response.splitlines():
+        if line.startswith('#'):
+            section = line[1:].strip()
+            continue
+        field, sep, value = line.partition(':')
+        if not sep:
+            continue
+        if section == 'Keyspace':
+            info[field] = parse_db(value)
+        else:
+            info[field] = value
+
+    return info
+
+def parse_keyspace(lines):
+    "Parse 'dbN:keys=..,expires=..' lines of an INFO dump into {db: {attribute: value}}"
+    keyspace = {}
+    for line in lines:
+        db, sep, value = line.strip().partition(':')
+        if sep and db.startswith('db') and db[2:].isdigit():
+            keyspace[db] = parse_db(value)
+    return keyspace
+
+def db_name(db, instance):
+    "Name of an instance's db in redis.keyspace and redis.keys keys, e.g. db0 or dlr:db0"
+    if instance == 'default':
+        return db
+    return '%s:%s' % (instance, db)
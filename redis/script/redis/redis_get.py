@@ -0,0 +1,446 @@
+#!/usr/bin/python
+# This a script that send metrics directly to Zabbix server
+# All metrics are gathered using Active agent.
+# Metrics are covering Redis INFO stats and keyspace
+
+import json, time, argparse, socket, sys, os, random, copy
+
+# Shared modules: this script's own and script/common/ ones
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [script_dir, os.path.join(os.path.dirname(script_dir), 'common')]
+from zabbix_common import MetricBatch, ZabbixBatchSender, Spool, LastValueCache, RunGuard, fetch
+from redis_common import discovery_cache_path, analysis_state_path, parse_info, db_name
+
+parser = argparse.ArgumentParser(description='Zabbix Redis status script')
+parser.add_argument('--hostname', required=True, help = "Redis' hostname (same configured in Zabbix hosts)")
+parser.add_argument('--zabbix-batch-size', type=int, default=250, help = "Maximum number of items per trapper packet")
+parser.add_argument('--zabbix-senders', type=int, default=1, help = "Number of concurrent connections to Zabbix trapper")
+parser.add_argument('--spool-dir', default='/tmp/redis_get.spool', help = "Where metrics failing to reach Zabbix are kept for replay")
+parser.add_argument('--spool-size', type=int, default=64, help = "Maximum spool size in MB (0 to disable spooling)")
+parser.add_argument('--spool-replay', type=int, default=10000, help = "Maximum number of spooled metrics replayed per cycle")
+parser.add_argument('--delta', action='store_true', help = "Send changed values only (and all values every --heartbeat seconds)")
+parser.add_argument('--heartbeat', type=int, default=600, help = "Maximum age of a value in Zabbix in delta mode (seconds)")
+parser.add_argument('--delta-cache', default='/tmp/redis_get.cache', help = "Where last sent values are kept between runs in delta mode")
+parser.add_argument('--instances', nargs='+', metavar='NAME=ADDRESS[:PORT]',
+    help = "Redis instances to monitor, port defaults to 6379 (default: default=127.0.0.1:6379)")
+parser.add_argument('--concurrency', type=int, default=4, help = "Number of Redis instances queried concurrently")
+parser.add_argument('--analyze', action='store_true', help = "Also analyze key families by walking the keyspace with SCAN")
+parser.add_argument('--analyze-interval', type=int, default=600, help = "Minimum delay between two keyspace analyses (seconds)")
+parser.add_argument('--analyze-budget', type=float, default=5,
+    help = "Maximum time spent walking an instance's keyspace per analysis (seconds), the walk goes on from there next time")
+parser.add_argument('--scan-count', type=int, default=500, help = "Number of keys asked per SCAN and inspected per pipeline")
+parser.add_argument('--sample', type=float, default=1.0, help = "Ratio of scanned keys inspected on very large databases (0 to 1)")
+parser.add_argument('--sample-above', type=int, default=1000000,
+    help = "Number of keys above which a database is very large and only a --sample ratio of its keys is inspected")
+parser.add_argument('--budget', type=float, default=50,
+    help = "Maximum duration of a collection (seconds), it is then cut short and what was collected is sent")
+parser.add_argument('--stale', type=int, default=300,
+    help = "Age of a running collection after which it is deemed hung and terminated by the next run (seconds)")
+args = parser.parse_args()
+
+# Configuration
+zabbix_host = 'monitoring.jookies.net'  # Zabbix Server IP
+zabbix_port = 30551                     # Zabbix Server Port
+redis = {'host': args.hostname, # Must be the same configured in Zabbix hosts !
+         'port': 6379,
+         'password': None}
+# name: (address, port), keys of instances other than 'default' carry their name
+redis['instances'] = {'default': ('127.0.0.1', redis['port'])}
+if args.instances:
+    redis['instances'] = {}
+    for instance in args.instances:
+        name, sep, endpoint = instance.rpartition('=')
+        address, sep, port = endpoint.partition(':')
+        if port and not port.isdigit():
+            parser.error('invalid port in --instances %s' % instance)
+        redis['instances'][name or 'default'] = (address or '127.0.0.1', int(port or redis['port']))
+# Instances and their dbs keyspace attributes, read by redis-db-discoverer.py
+discovery_cache = discovery_cache_path(redis['host'])
+# Keyspace analysis cursors and found families, also read by redis-db-discoverer.py
+analysis_state = analysis_state_path(redis['host'])
+# Runs exclusion (the script must not be executed simultaneously), see RunGuard
+run_guard = '/tmp/redis_get.run'
+
+# Monitoring keys
+keys = []
+keys.append({'stat': [
+    'blocked_clients',
+    'changes_since_last_save',
+    'client_biggest_input_buf',
+    'client_longest_output_list',
+    'total_commands_processed',
+    'connected_clients',
+    'connected_slaves',
+    'total_connections_received',
+    'evicted_keys',
+    'expired_keys',
+    'keyspace_hits',
+    'keyspace_misses',
+    'mem_fragmentation_ratio',
+    'uptime_in_seconds',
+    'used_memory_rss',
+    'used_cpu_sys',
+    'used_cpu_sys_childrens',
+    'used_cpu_user',
+    'used_cpu_user_childrens',
+    'used_memory',
+]})
+keys.append({'keyspace': [
+    'keys',
+    'expires',
+    'avg_ttl',
+]})
+# INFO fields renamed across Redis versions, tried in order for a stat key
+aliases = {
+    'changes_since_last_save': ['changes_since_last_save', 'rdb_changes_since_last_save'],
+    'used_cpu_sys_childrens': ['used_cpu_sys_childrens', 'used_cpu_sys_children'],
+    'used_cpu_user_childrens': ['used_cpu_user_childrens', 'used_cpu_user_children'],
+}
+
+# Key families of keyspace analysis: (name, key prefix), first matching wins
+families = [
+    ('dlr', 'dlr:'),                    # DLR lookups
+    ('queue-msgid', 'queue-msgid:'),    # Queue to SMSC message ids mapping
+    ('longcontent', 'longcontent:'),    # Long messages parts
+]
+# Upper bounds (seconds) of keys TTL histogram buckets, keys without TTL are counted apart
+ttl_buckets = [('1m', 60), ('1h', 3600), ('1d', 86400)]
+
+class RedisError(Exception):
+    pass
+
+class RedisClient(object):
+    """A minimal Redis client speaking RESP over a plain socket
+
+    Commands given to pipeline() are written at once and their replies read back
+    in order, error replies are returned as RedisError instances.
+    """
+
+    def __init__(self, host, port = 6379, password = None, timeout = 10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.rfile = self.sock.makefile('rb')
+        if self.password is not None:
+            self.execute('AUTH', self.password)
+
+    def execute(self, *command):
+        "Run a single command and return its reply, raise RedisError on error reply"
+        reply = self.pipeline([command])[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands):
+        "Run commands in one round-trip and return their replies"
+        if self.sock is None:
+            self.connect()
+
+        buf = []
+        for command in commands:
+            buf.append('*%d\r\n' % len(command))
+            for arg in command:
+                arg = str(arg)
+                buf.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            self.sock.sendall(''.join(buf))
+            return [self._read_reply() for command in commands]
+        except (socket.error, RedisError):
+            # Connection state is unknown, reconnect on next call
+            self.close()
+            raise
+
+    def _read_reply(self):
+        line = self.rfile.readline()
+        if not line.endswith('\r\n'):
+            raise RedisError('Connection closed by Redis')
+        kind, data = line[0], line[1:-2]
+        if kind == '+':
+            return data
+        elif kind == '-':
+            return RedisError(data)
+        elif kind == ':':
+            return int(data)
+        elif kind == '$':
+            length = int(data)
+            if length < 0:
+                return None
+            value = self.rfile.read(length + 2)
+            if len(value) != length + 2:
+                raise RedisError('Connection closed by Redis')
+            return value[:-2]
+        elif kind == '*':
+            length = int(data)
+            if length < 0:
+                return None
+            return [self._read_reply() for i in range(length)]
+        raise RedisError('Unknown reply type %r' % kind)
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+
+def get_stat(info, key):
+    "Value of stat key in parsed INFO, None if this Redis version does not have it"
+    for field in aliases.get(key, [key]):
+        if field in info:
+            return info[field]
+    return None
+
+def stat_key(key, instance):
+    "redis.stat key, instance is added as last parameter unless it is the default one"
+    if instance == 'default':
+        return 'redis.stat[%s]' % key
+    return 'redis.stat[%s,%s]' % (key, instance)
+
+def collect(client, instance):
+    "Return instance's metrics and keyspace ({db: {keys, expires, avg_ttl}}) from a single INFO command"
+    info = parse_info(client.execute('INFO'))
+    dbs = sorted(k for k in info if k.startswith('db') and type(info[k]) == dict)
+
+    metrics = MetricBatch()
+    for key in keys:
+        if type(key) == dict and 'stat' in key:
+            for subkey in key['stat']:
+                value = get_stat(info, subkey)
+                if value is not None:
+                    metrics.add(redis['host'], stat_key(subkey, instance), value)
+        elif type(key) == dict and 'keyspace' in key:
+            for db in dbs:
+                for subkey in key['keyspace']:
+                    if subkey in info[db]:
+                        metrics.add(redis['host'], 'redis.keyspace[%s,%s]' % (db_name(db, instance), subkey),
+                            info[db][subkey])
+
+    return metrics, dict((db, info[db]) for db in dbs)
+
+def key_family(key):
+    for name, prefix in families:
+        if key.startswith(prefix):
+            return name
+    return 'other'
+
+def ttl_bucket(ttl):
+    if ttl < 0:
+        return 'ttl_none'
+    for name, bound in ttl_buckets:
+        if ttl < bound:
+            return 'ttl_%s' % name
+    return 'ttl_more'
+
+def analyze(client, db, cursor, deadline, sample = 1.0):
+    """Walk db's keyspace with SCAN from cursor until its end or deadline
+
+    Every batch of scanned keys is inspected with one pipeline of TYPE, TTL and
+    MEMORY USAGE commands, a 'sample' ratio of them only. Return the per-family
+    stats of inspected keys, the number of scanned keys and the cursor to go on
+    from (0 once the walk is complete).
+    """
+    client.execute('SELECT', db[2:])
+    stats = {}
+    scanned = 0
+    while True:
+        cursor, keys = client.execute('SCAN', cursor, 'COUNT', args.scan_count)
+        scanned += len(keys)
+        if sample < 1:
+            keys = [k for k in keys if random.random() < sample]
+
+        commands = []
+        for k in keys:
+            commands.extend([('TYPE', k), ('TTL', k), ('MEMORY', 'USAGE', k)])
+        replies = client.pipeline(commands)
+        for i, k in enumerate(keys):
+            ktype, ttl, size = replies[i * 3:i * 3 + 3]
+            if ktype == 'none':
+                # Expired or deleted meanwhile
+                continue
+            family = stats.get(key_family(k))
+            if family is None:
+                family = stats[key_family(k)] = dict.fromkeys(['count', 'bytes', 'ttl_none', 'ttl_more'] +
+                    ['ttl_%s' % name for name, bound in ttl_buckets], 0)
+            family['count'] += 1
+            # MEMORY USAGE is only available from Redis 4.0
+            if not isinstance(size, RedisError) and size is not None:
+                family['bytes'] += size
+            family[ttl_bucket(ttl)] += 1
+
+        if cursor == '0' or time.time() >= deadline:
+            return stats, scanned, int(cursor)
+
+def analyze_instance(client, instance, keyspace, state, deadline = None):
+    """Analyze instance's dbs (keyspace as returned by collect()) within
+    '--analyze-budget' seconds (and by deadline if set), starting from cursors in
+    state, and return the metrics
+
+    Stats of a walk are accumulated in state across analyses until the walk is
+    complete. Counters are extrapolated to the whole db from the last complete
+    walk (or the walk in progress until there is one) and the db size, so they do
+    not depend on how far the budget let the current analysis go.
+    """
+    deadline = min(time.time() + args.analyze_budget, deadline or float('inf'))
+    metrics = MetricBatch()
+    for db in sorted(keyspace):
+        size = int(keyspace[db].get('keys', 0))
+        db_state = state.setdefault(db, {'cursor': 0, 'families': []})
+        walk = db_state.setdefault('walk', {'inspected': 0, 'stats': {}})
+        if time.time() < deadline:
+            # Only very large dbs are sampled
+            sample = args.sample if size > args.sample_above else 1.0
+            stats, scanned, db_state['cursor'] = analyze(client, db, db_state['cursor'], deadline, sample)
+            for name, family in stats.items():
+                walked = walk['stats'].setdefault(name, dict.fromkeys(family.keys(), 0))
+                for attr, value in family.items():
+                    walked[attr] += value
+                walk['inspected'] += family['count']
+            db_state['families'] = sorted(set(db_state['families']) | set(stats.keys()))
+            if db_state['cursor'] == 0:
+                db_state['done'] = walk
+                del db_state['walk']
+
+        estimated = db_state.get('done') or db_state.get('walk')
+        if estimated is None or estimated['inspected'] == 0:
+            continue
+        scale = float(size) / estimated['inspected']
+        for name in sorted(estimated['stats']):
+            for attr, value in sorted(estimated['stats'][name].items()):
+                metrics.add(redis['host'], 'redis.keys[%s,%s,%s]' % (db_name(db, instance), name, attr),
+                    int(round(value * scale)))
+        metrics.add(redis['host'], 'redis.keys[%s,inspected]' % db_name(db, instance), estimated['inspected'])
+
+    return metrics
+
+def collector_metrics(partial, runs = None):
+    """Build self-monitoring metrics of a collection, cut short if 'partial', and
+    of 'runs' (RunGuard.cycle() counts)"""
+    metrics = MetricBatch()
+    metrics.add(redis['host'], 'redis.collector[cycles.partial]', 1 if partial else 0)
+    if runs is not None:
+        for kind in ['coalesced', 'stale']:
+            metrics.add(redis['host'], 'redis.collector[cycles.%s]' % kind, runs[kind])
+
+    return metrics
+
+def collect_instances(clients, runs = None):
+    """Return metrics of every instance, queried concurrently through clients
+    ({name: RedisClient}), and self-monitoring ones (reporting runs if set)
+
+    Instances dbs are recorded for redis-db-discoverer.py, keys are analyzed when
+    an analysis is due. Instances still collecting after --budget seconds are
+    left behind with their client, replaced in clients, the metrics collected
+    until then are stamped with the collection start.
+    """
+    start = time.time()
+    budget = start + args.budget
+    instances = sorted(clients.keys())
+
+    # Keyspace analysis is due every '--analyze-interval' seconds
+    analysis = {'clock': 0, 'instances': {}}
+    if args.analyze and os.path.exists(analysis_state):
+        try:
+            with open(analysis_state, 'rb') as f:
+                analysis = json.load(f)
+        except ValueError, e:
+            print 'Ignoring corrupted analysis state %s: %s' % (analysis_state, e)
+    analyze_due = args.analyze and time.time() - analysis['clock'] >= args.analyze_interval
+    for name in instances:
+        analysis['instances'].setdefault(name, {})
+
+    def _collect(name):
+        client = clients[name]
+        metrics, keyspace = collect(client, name)
+        state = None
+        if analyze_due:
+            # Analyzed on a copy, an instance left behind must not change the saved state
+            state = copy.deepcopy(analysis['instances'][name])
+            try:
+                metrics.extend(analyze_instance(client, name, keyspace, state, budget))
+            except Exception, e:
+                print 'Error while analyzing instance %s: %s' % (name, e)
+        return metrics, keyspace, state
+
+    results = fetch([lambda name = name: _collect(name) for name in instances], args.concurrency, budget)
+
+    # Build outcome, an unreachable instance must not hide the others
+    metrics = MetricBatch()
+    discovered = {}
+    if os.path.exists(discovery_cache):
+        try:
+            with open(discovery_cache, 'rb') as f:
+                discovered = json.load(f)
+        except ValueError:
+            pass
+    partial = False
+    for name, result in zip(instances, results):
+        if result is None:
+            # Still collecting: its client stays with it, a new one is used next cycle
+            print 'Instance %s cut short after %ss' % (name, args.budget)
+            address, port = redis['instances'][name]
+            clients[name] = RedisClient(address, port, redis['password'])
+            partial = True
+            continue
+        if isinstance(result, Exception):
+            # Keep its last known dbs in discovery
+            print 'Error on instance %s: %s' % (name, result)
+            continue
+        metrics.extend(result[0])
+        discovered[name] = result[1]
+        if result[2] is not None:
+            analysis['instances'][name] = result[2]
+    if partial:
+        metrics.stamp(start)
+    metrics.extend(collector_metrics(partial, runs))
+
+    with open(discovery_cache + '.tmp', 'wb') as f:
+        json.dump(dict((name, keyspace) for name, keyspace in discovered.items() if name in redis['instances']), f)
+    os.rename(discovery_cache + '.tmp', discovery_cache)
+    if analyze_due:
+        analysis['clock'] = int(time.time())
+        with open(analysis_state + '.tmp', 'wb') as f:
+            json.dump(analysis, f)
+        os.rename(analysis_state + '.tmp', analysis_state)
+
+    return metrics
+
+def main():
+    # One connection per instance, reused by every command sent to it
+    clients = dict((name, RedisClient(address, port, redis['password']))
+        for name, (address, port) in redis['instances'].items())
+    sender = ZabbixBatchSender(zabbix_host, zabbix_port, batch_size = args.zabbix_batch_size,
+        concurrency = args.zabbix_senders,
+        spool = Spool(args.spool_dir, args.spool_size * 1024 * 1024, args.spool_replay) if args.spool_size > 0 else None,
+        cache = LastValueCache(args.delta_cache, args.heartbeat) if args.delta else None)
+    guard = RunGuard(run_guard, args.stale)
+    try:
+        # Runs must not overlap, one started meanwhile is coalesced into this one
+        if not guard.acquire():
+            print 'Previous run still running, coalesced into it'
+            return
+
+        # Collect once more for runs coalesced into this one meanwhile
+        while True:
+            metrics = collect_instances(clients, guard.cycle())
+
+            # Send packet to zabbix
+            sender.send(metrics)
+            if not guard.done():
+                break
+    except Exception, e:
+        print type(e)
+        print 'Error: %s' % e
+    finally:
+        for client in clients.values():
+            client.close()
+        sender.close()
+        guard.release()
+
+if __name__ == '__main__':
+    main()